@@ -1,12 +1,19 @@
+import asyncio
 import base64
 import binascii
+import hashlib
 import re
+from datetime import timedelta
+from typing import Optional
 
-from aiohttp import ClientSession
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
 from discord import Embed, Forbidden, Message
+from discord.utils import DISCORD_EPOCH, snowflake_time, utcnow
 
 from PyDrocsid.cog import Cog
+from PyDrocsid.logger import get_logger
 from PyDrocsid.material_colors import MaterialColors
+from PyDrocsid.redis import redis
 from PyDrocsid.translations import t
 
 from ...contributor import Contributor
@@ -16,10 +23,106 @@ from ...pubsub import send_alert
 tg = t.g
 t = t.discord_bot_token_deleter
 
+logger = get_logger(__name__)
+
+# lengths of the three segments of a token (the user id, the timestamp and the hmac)
+USER_ID_LENGTH = range(23, 29)
+TIMESTAMP_LENGTH = range(6, 9)
+HMAC_LENGTH = range(27, 39)
+
+# older tokens store their timestamp relative to this epoch instead of the unix epoch
+TOKEN_EPOCH = 1293840000
+
+# maximum time (in seconds) to verify a single token
+VERIFY_TIMEOUT = 5
+
+# time (in seconds) for which the verdicts of the discord api are cached
+VALID_CACHE_TTL = 60 * 60
+INVALID_CACHE_TTL = 7 * 24 * 60 * 60
+
+_session: Optional[ClientSession] = None
+
+
+def get_session() -> ClientSession:
+    """Return the http client session which is shared by all token verifications."""
+
+    global _session
+
+    if _session is None or _session.closed:
+        _session = ClientSession(timeout=ClientTimeout(total=VERIFY_TIMEOUT), connector=TCPConnector(limit=10))
+
+    return _session
+
+
+def close_session():
+    """Close the session of the token verifications."""
+
+    global _session
+
+    if _session is not None and not _session.closed:
+        asyncio.create_task(_session.close())
+    _session = None
+
+
+def decode_segment(segment: str) -> bytes:
+    """Decode a base64 token segment, which is stored without padding."""
+
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+
+def is_plausible_token(user_id: str, timestamp: str, hmac: str) -> bool:
+    """Check the structure of a token locally, so only plausible tokens have to be verified using the discord api."""
+
+    if len(user_id) not in USER_ID_LENGTH or len(timestamp) not in TIMESTAMP_LENGTH or len(hmac) not in HMAC_LENGTH:
+        return False
+
+    try:
+        snowflake = decode_segment(user_id)
+        created = int.from_bytes(decode_segment(timestamp), "big")
+    except (binascii.Error, ValueError):
+        return False
+
+    if not snowflake.isdigit() or not 17 <= len(snowflake) <= 20:
+        return False
+
+    now = utcnow()
+    if not snowflake_time(int(snowflake)) <= now:
+        return False
+
+    latest = (now + timedelta(days=1)).timestamp()
+    return any(DISCORD_EPOCH / 1000 <= ts <= latest for ts in [created, created + TOKEN_EPOCH])
+
+
+async def verify_token(token: str) -> bool:
+    """Return whether a token is valid. Verdicts are cached by the hash of the token."""
+
+    key = f"bot_token:{hashlib.sha256(token.encode()).hexdigest()}"
+    if (cached := await redis.get(key)) is not None:
+        return cached == "1"
+
+    try:
+        async with get_session().get(
+            "https://discord.com/api/users/@me", headers={"Authorization": f"Bot {token}"}
+        ) as response:
+            valid = response.ok
+            status = response.status
+    except (ClientError, asyncio.TimeoutError) as e:
+        logger.warning("could not verify token: %s", e)
+        return False
+
+    # rate limits and server errors do not say anything about the token
+    if valid or status == 401:
+        await redis.setex(key, VALID_CACHE_TTL if valid else INVALID_CACHE_TTL, int(valid))
+
+    return valid
+
 
 class DiscordBotTokenDeleterCog(Cog, name="Discord Bot Token Deleter"):
     CONTRIBUTORS = [Contributor.Tert0, Contributor.Defelo]
-    RE_DC_TOKEN = re.compile(r"([A-Za-z\d\-_]+)\.[A-Za-z\d\-_]+\.[A-Za-z\d\-_]+")
+    RE_DC_TOKEN = re.compile(r"([A-Za-z\d\-_]+)\.([A-Za-z\d\-_]+)\.([A-Za-z\d\-_]+)")
+
+    def cog_unload(self):
+        close_session()
 
     async def on_message(self, message: Message):
         """Delete a message if it contains a Discord bot token"""
@@ -28,17 +131,8 @@ class DiscordBotTokenDeleterCog(Cog, name="Discord Bot Token Deleter"):
             return
 
         for match in self.RE_DC_TOKEN.finditer(message.content):
-            try:
-                if not base64.urlsafe_b64decode(match.group(1)).isdigit():
-                    continue
-            except binascii.Error:
-                continue
-
-            async with ClientSession() as session, session.get(
-                "https://discord.com/api/users/@me", headers={"Authorization": f"Bot {match.group(0)}"}
-            ) as response:
-                if response.ok:
-                    break
+            if is_plausible_token(*match.groups()) and await verify_token(match.group(0)):
+                break
         else:
             return
 
@@ -0,0 +1,81 @@
+from array import array
+from collections import Counter
+from datetime import datetime
+from typing import Optional
+
+from PyDrocsid.database import db_context
+from PyDrocsid.logger import get_logger
+
+from .histogram import HISTORY_DAYS, MAX_DAILY_COUNT, day_number
+from .models import Activity, DailyActivity
+
+
+logger = get_logger(__name__)
+
+# interval (in seconds) in which buffered activity is written to the database
+FLUSH_INTERVAL = 60
+
+
+class ActivityBuffer:
+    """
+    Write-behind buffer for the activity of users and roles.
+
+    Only the most recent timestamp and the message counts per day of each id are kept in memory and written to the
+    database periodically, so a busy server does not cause one database query per message.
+    """
+
+    def __init__(self):
+        self.pending: dict[int, datetime] = {}
+        # id -> day -> number of messages
+        self.daily: dict[int, Counter[int]] = {}
+
+    def add(self, object_id: int, timestamp: datetime):
+        if (current := self.pending.get(object_id)) is None or timestamp > current:
+            self.pending[object_id] = timestamp
+
+    def merge(self, object_id: int, timestamp: Optional[datetime]) -> Optional[datetime]:
+        """Return the most recent of the given timestamp and the pending timestamp of an id."""
+
+        if (pending := self.pending.get(object_id)) is None:
+            return timestamp
+        if timestamp is None:
+            return pending
+
+        return max(timestamp, pending)
+
+    def count(self, object_id: int, timestamp: datetime):
+        self.daily.setdefault(object_id, Counter())[day_number(timestamp)] += 1
+
+    def merge_histogram(self, object_id: int, histogram: array, today: int) -> array:
+        """Add the pending message counts of an id to a histogram returned by DailyActivity.get_many."""
+
+        for day, count in self.daily.get(object_id, {}).items():
+            if 0 <= (age := today - day) < HISTORY_DAYS:
+                index = HISTORY_DAYS - 1 - age
+                histogram[index] = min(histogram[index] + count, MAX_DAILY_COUNT)
+        return histogram
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        daily, self.daily = self.daily, {}
+        if not pending and not daily:
+            return
+
+        try:
+            async with db_context():
+                await Activity.update_many(pending)
+                await DailyActivity.add_many(daily)
+        except Exception:
+            logger.exception("could not flush activity of %d ids", len(pending))
+
+            # keep the activity for the next attempt
+            for object_id, timestamp in pending.items():
+                self.add(object_id, timestamp)
+            for object_id, counts in daily.items():
+                self.daily.setdefault(object_id, Counter()).update(counts)
+            return
+
+        logger.debug("flushed activity of %d ids", len(pending))
+
+
+activity_buffer = ActivityBuffer()
@@ -1,21 +1,24 @@
 import asyncio
-from datetime import datetime, timedelta
-from typing import Optional
+from array import array
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Optional
 
-from discord import Embed, Guild, Member, Message, NotFound, Permissions, Role, Status, TextChannel
-from discord.ext import commands
+from discord import Embed, Guild, Member, Message, NotFound, Object, Permissions, Role, Status, TextChannel
+from discord.ext import commands, tasks
 from discord.ext.commands import CommandError, Context, guild_only, max_concurrency
-from discord.utils import format_dt, utcnow
+from discord.utils import format_dt, snowflake_time, utcnow
 
 from PyDrocsid.async_thread import run_as_task, semaphore_gather
 from PyDrocsid.cog import Cog
 from PyDrocsid.command import optional_permissions, reply
 from PyDrocsid.config import Contributor
-from PyDrocsid.database import db, db_wrapper
+from PyDrocsid.database import db, db_context
 from PyDrocsid.embeds import send_long_embed
 from PyDrocsid.translations import t
 
-from .models import Activity
+from .buffer import FLUSH_INTERVAL, activity_buffer
+from .histogram import HISTORY_DAYS, active_days, day_number, empty_histogram, sum_histograms
+from .models import Activity, DailyActivity, ScanCheckpoint
 from .permissions import InactivityPermission
 from .settings import InactivitySettings
 from ...pubsub import get_user_status_entries, ignore_message_edit, send_to_changelog
@@ -24,6 +27,12 @@ from ...pubsub import get_user_status_entries, ignore_message_edit, send_to_chan
 tg = t.g
 t = t.inactivity
 
+# number of messages after which the progress of a channel scan is saved
+CHECKPOINT_INTERVAL = 1000
+
+# default number of days of the daily activity histogram which are evaluated by the activity commands
+DEFAULT_HISTORY_DAYS = 30
+
 
 def status_icon(status: Status) -> str:
     return {
@@ -34,6 +43,21 @@ def status_icon(status: Status) -> str:
     }[status]
 
 
+def format_day(day: int) -> str:
+    return format_dt(datetime.fromtimestamp(day * 86400, timezone.utc), style="d")
+
+
+async def get_histograms(members: Iterable[Member], today: int) -> dict[Member, array]:
+    """Return the daily activity histograms of the given members, including the activity which is still buffered."""
+
+    members = list(members)
+    histograms = await DailyActivity.get_many((member.id for member in members), today)
+    return {
+        member: activity_buffer.merge_histogram(member.id, histograms.get(member.id) or empty_histogram(), today)
+        for member in members
+    }
+
+
 @run_as_task
 async def scan(ctx: Context, days: int):
     async def update_msg(m: Message, content):
@@ -49,9 +73,11 @@ async def scan(ctx: Context, days: int):
     embed = Embed(title=t.scanning, timestamp=utcnow())
     message: list[Message] = [await reply(ctx, embed=embed)]
     guild: Guild = ctx.guild
-    members: dict[Member, datetime] = {}
+    cutoff = utcnow() - timedelta(days=days)
+    updated: set[int] = set()
     active: dict[TextChannel, int] = {}
     completed: list[TextChannel] = []
+    lock = asyncio.Lock()
 
     async def update_progress_message():
         while len(completed) < len(channels):
@@ -63,14 +89,61 @@ async def scan(ctx: Context, days: int):
             await asyncio.sleep(2)
 
     async def update_members(c: TextChannel):
+        """
+        Scan the history of a channel, skipping the range covered by previous scans.
+
+        The activity found so far is saved together with the scanned range every few messages,
+        so an interrupted scan continues where it stopped.
+        """
+
         active[c] = 0
 
-        async for msg in c.history(limit=None, oldest_first=False):
-            s = (utcnow() - msg.created_at).total_seconds()
-            if s > days * 24 * 60 * 60:
-                break
-            members[msg.author] = max(members.get(msg.author, msg.created_at), msg.created_at)
-            active[c] = int(s / (24 * 60 * 60))
+        async with db_context():
+            checkpoint = await ScanCheckpoint.get(c.id)
+            newest_id, oldest_id, complete = checkpoint.newest_id, checkpoint.oldest_id, checkpoint.complete
+
+        pending: dict[int, datetime] = {}
+        count = 0
+
+        async def save():
+            async with lock, db_context():
+                await Activity.update_many(pending)
+                await ScanCheckpoint.save(c.id, newest_id, oldest_id, complete)
+            updated.update(pending)
+            pending.clear()
+
+        def record(msg: Message):
+            nonlocal count
+
+            pending[msg.author.id] = max(pending.get(msg.author.id, msg.created_at), msg.created_at)
+            active[c] = (utcnow() - msg.created_at).days
+            count += 1
+
+        # messages which have been sent since the last scan
+        if newest_id is not None or complete:
+            after = Object(newest_id) if newest_id is not None else None
+            async for msg in c.history(limit=None, after=after, oldest_first=True):
+                record(msg)
+                newest_id = msg.id
+                if count % CHECKPOINT_INTERVAL == 0:
+                    await save()
+
+        # messages which are older than the range covered by previous scans
+        if not complete and (oldest_id is None or snowflake_time(oldest_id) > cutoff):
+            before = Object(oldest_id) if oldest_id is not None else None
+            async for msg in c.history(limit=None, before=before, oldest_first=False):
+                if msg.created_at < cutoff:
+                    break
+
+                record(msg)
+                oldest_id = msg.id
+                newest_id = newest_id or msg.id
+                if count % CHECKPOINT_INTERVAL == 0:
+                    await save()
+            else:
+                complete = True
+
+        await save()
 
         del active[c]
         completed.append(c)
@@ -88,27 +161,40 @@ async def scan(ctx: Context, days: int):
         task.cancel()
 
     await update_msg(message[0], t.scan_complete(cnt=len(guild.text_channels)))
+    await reply(ctx, embed=Embed(title=t.scan_results, description=t.updated_members(cnt=len(updated))))
 
-    embed = Embed(title=t.updating_members)
-    message: Message = await reply(ctx, embed=embed)
 
-    await semaphore_gather(50, *[db_wrapper(Activity.update)(m.id, ts) for m, ts in members.items()])
+class InactivityCog(Cog, name="Inactivity"):
+    CONTRIBUTORS = [Contributor.Defelo]
 
-    await update_msg(message, t.updated_members(cnt=len(members)))
+    async def on_ready(self):
+        try:
+            self.flush_loop.start()
+        except RuntimeError:
+            self.flush_loop.restart()
 
+    def cog_unload(self):
+        self.flush_loop.cancel()
 
-class InactivityCog(Cog, name="Inactivity"):
-    CONTRIBUTORS = [Contributor.Defelo]
+    @tasks.loop(seconds=FLUSH_INTERVAL)
+    async def flush_loop(self):
+        await activity_buffer.flush()
+
+    @flush_loop.after_loop
+    async def after_flush_loop(self):
+        # write the remaining activity when the loop is stopped (e.g. when the cog is unloaded)
+        await activity_buffer.flush()
 
     async def on_message(self, message: Message):
         if message.guild is None:
             return
 
-        await Activity.update(message.author.id, message.created_at)
+        activity_buffer.add(message.author.id, message.created_at)
+        activity_buffer.count(message.author.id, message.created_at)
 
         role: Role
         for role in message.role_mentions:
-            await Activity.update(role.id, message.created_at)
+            activity_buffer.add(role.id, message.created_at)
 
     @commands.command()
     @InactivityPermission.scan.check
@@ -129,13 +215,14 @@ class InactivityCog(Cog, name="Inactivity"):
         inactive_days = await InactivitySettings.inactive_days.get()
 
         activity: Optional[Activity] = await db.get(Activity, id=user_id)
+        timestamp = activity_buffer.merge(user_id, activity.timestamp if activity else None)
 
-        if activity is None:
+        if timestamp is None:
             status = t.status.inactive
-        elif (utcnow() - activity.timestamp).days >= inactive_days:
-            status = t.status.inactive_since(format_dt(activity.timestamp, style="R"))
+        elif (utcnow() - timestamp).days >= inactive_days:
+            status = t.status.inactive_since(format_dt(timestamp, style="R"))
         else:
-            status = t.status.active(format_dt(activity.timestamp, style="R"))
+            status = t.status.active(format_dt(timestamp, style="R"))
 
         return [(t.activity, status)]
 
@@ -156,26 +243,26 @@ class InactivityCog(Cog, name="Inactivity"):
         elif days not in range(1, 10001):
             raise CommandError(tg.invalid_duration)
 
-        now = utcnow()
-
-        @db_wrapper
-        async def load_member(m: Member) -> tuple[Member, Optional[datetime]]:
-            ts = await db.get(Activity, id=m.id)
-            return m, ts.timestamp if ts else None
+        threshold = utcnow() - timedelta(days=days)
 
         if roles:
             members: set[Member] = {member for role in roles for member in role.members}
+            timestamps = await Activity.get_many(member.id for member in members)
         else:
-            members: set[Member] = set(ctx.guild.members)
+            # only members which have not been active since the threshold according to the database are relevant
+            active, timestamps = await Activity.get_inactive(threshold)
+            members: set[Member] = {member for member in ctx.guild.members if member.id not in active}
 
-        last_activity: list[tuple[Member, Optional[datetime]]] = await semaphore_gather(50, *map(load_member, members))
+        last_activity: list[tuple[Member, Optional[datetime]]] = [
+            (member, activity_buffer.merge(member.id, timestamps.get(member.id))) for member in members
+        ]
         last_activity.sort(key=lambda a: (a[1].timestamp() if a[1] else -1, str(a[0])))
 
         out = []
         for member, timestamp in last_activity:
             if timestamp is None:
                 out.append(t.user_inactive(status_icon(member.status), member.mention, f"@{member}"))
-            elif timestamp >= now - timedelta(days=days):
+            elif timestamp >= threshold:
                 break
             else:
                 out.append(
@@ -193,6 +280,84 @@ class InactivityCog(Cog, name="Inactivity"):
             embed.colour = 0x03AD28
         await send_long_embed(ctx, embed, paginate=True)
 
+    @commands.command(aliases=["ra"])
+    @InactivityPermission.read.check
+    @guild_only()
+    async def rarely_active(self, ctx: Context, min_days: int, days: Optional[int], *roles: Optional[Role]):
+        """
+        list users which have been active on less than min_days of the last days
+        """
+
+        if role := ctx.guild.get_role(days):
+            roles += (role,)
+            days = None
+
+        if days is None:
+            days = DEFAULT_HISTORY_DAYS
+        elif days not in range(1, HISTORY_DAYS + 1):
+            raise CommandError(t.invalid_history_duration(HISTORY_DAYS))
+
+        if min_days not in range(1, days + 1):
+            raise CommandError(t.invalid_min_days(days))
+
+        if roles:
+            members: set[Member] = {member for role in roles for member in role.members}
+        else:
+            members: set[Member] = set(ctx.guild.members)
+        histograms = await get_histograms(members, day_number(utcnow()))
+
+        rarely_active: list[tuple[Member, int]] = []
+        for member, histogram in histograms.items():
+            if (cnt := active_days(histogram, days)) < min_days:
+                rarely_active.append((member, cnt))
+        rarely_active.sort(key=lambda a: (a[1], str(a[0])))
+
+        embed = Embed(title=t.rarely_active_users, colour=0x256BE6)
+        if rarely_active:
+            embed.title = t.rarely_active_users_cnt(len(rarely_active))
+            embed.description = "\n".join(
+                t.user_active_days(status_icon(member.status), member.mention, f"@{member}", cnt=cnt)
+                for member, cnt in rarely_active
+            )
+        else:
+            embed.description = t.no_rarely_active_users
+            embed.colour = 0x03AD28
+        await send_long_embed(ctx, embed, paginate=True)
+
+    @commands.command(aliases=["ract"])
+    @InactivityPermission.read.check
+    @guild_only()
+    async def role_activity(self, ctx: Context, role: Role, days: Optional[int]):
+        """
+        show a summary of the activity of the members of a role
+        """
+
+        if days is None:
+            days = DEFAULT_HISTORY_DAYS
+        elif days not in range(1, HISTORY_DAYS + 1):
+            raise CommandError(t.invalid_history_duration(HISTORY_DAYS))
+
+        today = day_number(utcnow())
+        histograms = await get_histograms(role.members, today)
+        totals = sum_histograms(histograms.values(), days)
+        days_active = [active_days(histogram, days) for histogram in histograms.values()]
+
+        embed = Embed(title=t.role_activity(role.name), colour=0x256BE6)
+        embed.add_field(name=t.messages, value=str(sum(totals)))
+        embed.add_field(name=t.active_members, value=f"{sum(map(bool, days_active))} / {len(days_active)}")
+        if days_active:
+            embed.add_field(name=t.average_active_days, value=f"{sum(days_active) / len(days_active):.1f}")
+
+        # message counts per week, most recent week first
+        weeks = []
+        for end in range(days, 0, -7):
+            start = max(0, end - 7)
+            first_day, last_day = today - days + 1 + start, today - days + end
+            weeks.append(t.week_messages(format_day(first_day), format_day(last_day), sum(totals[start:end])))
+        embed.description = t.role_activity_period(cnt=days) + "\n\n" + "\n".join(weeks)
+
+        await send_long_embed(ctx, embed, paginate=True)
+
     @commands.command(aliases=["indur"])
     @InactivityPermission.read.check
     @optional_permissions(InactivityPermission.write)
@@ -0,0 +1,102 @@
+import sys
+from array import array
+from datetime import datetime
+from operator import add
+from typing import Iterable
+
+
+# number of days covered by the daily activity histogram of a user
+HISTORY_DAYS = 365
+
+# maximum number of messages per day which can be stored in the histogram
+MAX_DAILY_COUNT = 0xFFFF
+
+
+def day_number(timestamp: datetime) -> int:
+    """Return the number of days between the unix epoch and the given timestamp."""
+
+    return int(timestamp.timestamp() // 86400)
+
+
+def empty_histogram() -> array:
+    return array("H", bytes(2 * HISTORY_DAYS))
+
+
+def load_histogram(data: bytes) -> array:
+    """Decode a ring buffer of little endian uint16 counts."""
+
+    counts = array("H", data)
+    if sys.byteorder == "big":
+        counts.byteswap()
+    return counts
+
+
+def dump_histogram(counts: array) -> bytes:
+    """Encode a ring buffer as little endian uint16 counts."""
+
+    if sys.byteorder == "big":
+        counts = array("H", counts)
+        counts.byteswap()
+    return counts.tobytes()
+
+
+def advance_histogram(counts: array, last_day: int, day: int) -> None:
+    """Clear the slots of all days after last_day up to the given day, so they can be reused for these days."""
+
+    if day - last_day >= HISTORY_DAYS:
+        counts[:] = empty_histogram()
+        return
+
+    for d in range(last_day + 1, day + 1):
+        counts[d % HISTORY_DAYS] = 0
+
+
+def add_counts(counts: array, last_day: int, daily: dict[int, int]) -> int:
+    """
+    Add message counts per day to a ring buffer whose most recent day is last_day.
+
+    :return: the most recent day of the updated ring buffer
+    """
+
+    newest = max(last_day, *daily)
+    advance_histogram(counts, last_day, newest)
+    for day, count in daily.items():
+        if newest - day < HISTORY_DAYS:
+            counts[day % HISTORY_DAYS] = min(counts[day % HISTORY_DAYS] + count, MAX_DAILY_COUNT)
+    return newest
+
+
+def align_histogram(counts: array, last_day: int, today: int) -> array:
+    """
+    Convert a ring buffer into a histogram of the last HISTORY_DAYS days.
+
+    The last element of the returned array is the count of today, the first one the count of HISTORY_DAYS - 1 days ago.
+    """
+
+    shift = today - last_day
+    if shift >= HISTORY_DAYS:
+        return empty_histogram()
+
+    split = (last_day + 1) % HISTORY_DAYS
+    ordered = counts[split:] + counts[:split]
+    if shift <= 0:
+        return ordered
+
+    return ordered[shift:] + array("H", bytes(2 * shift))
+
+
+def active_days(histogram: array, days: int) -> int:
+    """Return the number of days within the last days days on which at least one message has been sent."""
+
+    start = HISTORY_DAYS - days
+    return days - histogram[start:].count(0)
+
+
+def sum_histograms(histograms: Iterable[array], days: int) -> list[int]:
+    """Return the total message count per day of the last days days, oldest first."""
+
+    start = HISTORY_DAYS - days
+    totals = [0] * days
+    for histogram in histograms:
+        totals = list(map(add, totals, histogram[start:]))
+    return totals
@@ -1,11 +1,19 @@
 from __future__ import annotations
 
+from array import array
 from datetime import datetime
-from typing import Union
+from typing import Iterable, Optional, Union
 
-from sqlalchemy import BigInteger, Column
+from sqlalchemy import BigInteger, Boolean, Column, Integer, LargeBinary, func
+from sqlalchemy.dialects import mysql, postgresql
 
-from PyDrocsid.database import Base, UTCDateTime, db
+from PyDrocsid.database import Base, UTCDateTime, db, select
+
+from .histogram import HISTORY_DAYS, add_counts, align_histogram, dump_histogram, empty_histogram, load_histogram
+
+
+# maximum number of ids per query of a bulk update
+UPDATE_CHUNK_SIZE = 1000
 
 
 class Activity(Base):
@@ -27,3 +35,146 @@ class Activity(Base):
         elif timestamp > row.timestamp:
             row.timestamp = timestamp
         return row
+
+    @staticmethod
+    async def update_many(timestamps: dict[int, datetime]) -> None:
+        """
+        Update the activity of multiple ids at once, keeping the most recent timestamp of each id.
+
+        On MySQL/MariaDB and PostgreSQL the rows are upserted using chunked multi-row statements,
+        which all run in the transaction of the current database session.
+        """
+
+        rows = [{"id": object_id, "timestamp": timestamp} for object_id, timestamp in timestamps.items()]
+        dialect: str = db.engine.dialect.name
+        for start in range(0, len(rows), UPDATE_CHUNK_SIZE):
+            end = start + UPDATE_CHUNK_SIZE
+            chunk = rows[start:end]
+            if dialect in ("mysql", "mariadb"):
+                statement = mysql.insert(Activity).values(chunk)
+                statement = statement.on_duplicate_key_update(
+                    timestamp=func.greatest(Activity.timestamp, statement.inserted.timestamp)
+                )
+            elif dialect == "postgresql":
+                statement = postgresql.insert(Activity).values(chunk)
+                statement = statement.on_conflict_do_update(
+                    index_elements=[Activity.id],
+                    set_={"timestamp": func.greatest(Activity.timestamp, statement.excluded.timestamp)},
+                )
+            else:
+                await Activity._merge_many({row["id"]: row["timestamp"] for row in chunk})
+                continue
+
+            await db.exec(statement)
+
+    @staticmethod
+    async def get_many(ids: Iterable[int]) -> dict[int, datetime]:
+        """Return the timestamps of the given ids which have an activity, using chunked queries."""
+
+        ids = list(ids)
+        out: dict[int, datetime] = {}
+        for start in range(0, len(ids), UPDATE_CHUNK_SIZE):
+            end = start + UPDATE_CHUNK_SIZE
+            result = await db.exec(select(Activity.id, Activity.timestamp).filter(Activity.id.in_(ids[start:end])))
+            out.update(result.all())
+        return out
+
+    @staticmethod
+    async def get_inactive(threshold: datetime) -> tuple[set[int], dict[int, datetime]]:
+        """Return the ids which have been active since the threshold and the timestamps of all other ids."""
+
+        active = await db.exec(select(Activity.id).filter(Activity.timestamp >= threshold))
+        inactive = await db.exec(select(Activity.id, Activity.timestamp).filter(Activity.timestamp < threshold))
+        return set(active.scalars().all()), dict(inactive.all())
+
+    @staticmethod
+    async def _merge_many(timestamps: dict[int, datetime]) -> None:
+        """Fallback for update_many on databases without a supported upsert statement."""
+
+        rows: dict[int, Activity] = {
+            row.id: row async for row in await db.stream(select(Activity).filter(Activity.id.in_(list(timestamps))))
+        }
+        for object_id, timestamp in timestamps.items():
+            if (row := rows.get(object_id)) is None:
+                await Activity.create(object_id, timestamp)
+            elif timestamp > row.timestamp:
+                row.timestamp = timestamp
+
+
+class ScanCheckpoint(Base):
+    """Range of the history of a channel which has already been scanned."""
+
+    __tablename__ = "inactivity_scan_checkpoint"
+
+    channel_id: Union[Column, int] = Column(BigInteger, primary_key=True, unique=True)
+    newest_id: Union[Column, Optional[int]] = Column(BigInteger, nullable=True)
+    oldest_id: Union[Column, Optional[int]] = Column(BigInteger, nullable=True)
+    # whether there are no messages before oldest_id
+    complete: Union[Column, bool] = Column(Boolean, default=False)
+
+    @staticmethod
+    async def get(channel_id: int) -> ScanCheckpoint:
+        if not (row := await db.get(ScanCheckpoint, channel_id=channel_id)):
+            row = ScanCheckpoint(channel_id=channel_id, newest_id=None, oldest_id=None, complete=False)
+            await db.add(row)
+        return row
+
+    @staticmethod
+    async def save(channel_id: int, newest_id: Optional[int], oldest_id: Optional[int], complete: bool):
+        row = await ScanCheckpoint.get(channel_id)
+        row.newest_id, row.oldest_id, row.complete = newest_id, oldest_id, complete
+
+
+class DailyActivity(Base):
+    """Number of messages of a user on each of the last HISTORY_DAYS days."""
+
+    __tablename__ = "inactivity_daily_activity"
+
+    id: Union[Column, int] = Column(BigInteger, primary_key=True, unique=True)
+    # most recent day (in days since the unix epoch) which has been written to the histogram
+    day: Union[Column, int] = Column(Integer)
+    # ring buffer of little endian uint16 counts, the count of a day is stored at index day % HISTORY_DAYS
+    counts: Union[Column, bytes] = Column(LargeBinary(2 * HISTORY_DAYS))
+
+    @staticmethod
+    async def add_many(daily: dict[int, dict[int, int]]) -> None:
+        """Add message counts per day (id -> day -> count) to the histograms of multiple ids."""
+
+        ids = list(daily)
+        for start in range(0, len(ids), UPDATE_CHUNK_SIZE):
+            end = start + UPDATE_CHUNK_SIZE
+            chunk = ids[start:end]
+            rows: dict[int, DailyActivity] = {
+                row.id: row async for row in await db.stream(select(DailyActivity).filter(DailyActivity.id.in_(chunk)))
+            }
+            for object_id in chunk:
+                if (row := rows.get(object_id)) is None:
+                    counts = empty_histogram()
+                    day = add_counts(counts, min(daily[object_id]), daily[object_id])
+                    await db.add(DailyActivity(id=object_id, day=day, counts=dump_histogram(counts)))
+                    continue
+
+                counts = load_histogram(row.counts)
+                row.day = add_counts(counts, row.day, daily[object_id])
+                row.counts = dump_histogram(counts)
+
+    @staticmethod
+    async def get_many(ids: Iterable[int], today: int) -> dict[int, array]:
+        """
+        Return the histograms of the given ids which have a daily activity, using chunked queries.
+
+        The last element of each histogram is the count of today, the first one the count of HISTORY_DAYS - 1 days ago.
+        """
+
+        ids = list(ids)
+        out: dict[int, array] = {}
+        for start in range(0, len(ids), UPDATE_CHUNK_SIZE):
+            end = start + UPDATE_CHUNK_SIZE
+            result = await db.exec(
+                select(DailyActivity.id, DailyActivity.day, DailyActivity.counts).filter(
+                    DailyActivity.id.in_(ids[start:end])
+                )
+            )
+            for object_id, day, counts in result.all():
+                out[object_id] = align_histogram(load_histogram(counts), day, today)
+        return out
@@ -28,7 +28,6 @@ from PyDrocsid.cog import Cog
 from PyDrocsid.command import optional_permissions, reply
 from PyDrocsid.config import Contributor
 from PyDrocsid.database import db, db_context, db_wrapper, filter_by
-from PyDrocsid.embeds import send_long_embed
 from PyDrocsid.emojis import name_to_emoji
 from PyDrocsid.logger import get_logger
 from PyDrocsid.settings import RoleSettings
@@ -36,14 +35,17 @@ from PyDrocsid.translations import t
 
 from .colors import Colors
 from .models import Join, Leave, UsernameUpdate, Verification
+from .pagination import UserlogPaginator
 from .permissions import UserInfoPermission
 from ...pubsub import (
     get_user_info_entries,
     get_user_status_entries,
     get_userlog_entries,
+    get_userlog_sources,
     revoke_verification,
     send_alert,
 )
+from ...userlog import UserlogSource, UserlogTimeline, query_source, static_source
 
 
 logger = get_logger(__name__)
@@ -52,6 +54,20 @@ tg = t.g
 t = t.user_info
 
 
+def format_username_update(username_update: UsernameUpdate) -> str:
+    if not username_update.nick:
+        return t.ulog.username_updated(username_update.member_name, username_update.new_name)
+    if username_update.member_name is None:
+        return t.ulog.nick.set(username_update.new_name)
+    if username_update.new_name is None:
+        return t.ulog.nick.cleared(username_update.member_name)
+    return t.ulog.nick.updated(username_update.member_name, username_update.new_name)
+
+
+def format_verification(verification: Verification) -> str:
+    return t.ulog.verification.accepted if verification.accepted else t.ulog.verification.revoked
+
+
 def date_diff_to_str(date1: datetime, date2: datetime):
     rd = relativedelta(date1, date2)
     if rd.years:
@@ -253,56 +269,37 @@ class UserInfoCog(Cog, name="User Information"):
 
         user, user_id, arg_passed = await get_user(ctx, user, UserInfoPermission.view_userlog)
 
-        out: list[tuple[datetime, str]] = [(snowflake_time(user_id), t.ulog.created)]
+        sources: list[UserlogSource] = [
+            static_source((snowflake_time(user_id), t.ulog.created)),
+            query_source(filter_by(Join, member=user_id), Join.timestamp, lambda join: t.ulog.joined(join.member_name)),
+            query_source(filter_by(Leave, member=user_id), Leave.timestamp, lambda _: t.ulog.left),
+            query_source(filter_by(UsernameUpdate, member=user_id), UsernameUpdate.timestamp, format_username_update),
+        ]
 
-        join: Join
-        async for join in await db.stream(filter_by(Join, member=user_id)):
-            out.append((join.timestamp, t.ulog.joined(join.member_name)))
+        if await RoleSettings.get("verified") in {role.id for role in guild.roles}:
+            sources.append(
+                query_source(filter_by(Verification, member=user_id), Verification.timestamp, format_verification)
+            )
 
-        leave: Leave
-        async for leave in await db.stream(filter_by(Leave, member=user_id)):
-            out.append((leave.timestamp, t.ulog.left))
+        for response in await get_userlog_sources(user_id, ctx.author):
+            sources += response
+        for entries in await get_userlog_entries(user_id, ctx.author):
+            sources.append(static_source(*entries))
 
-        username_update: UsernameUpdate
-        async for username_update in await db.stream(filter_by(UsernameUpdate, member=user_id)):
-            if not username_update.nick:
-                msg = t.ulog.username_updated(username_update.member_name, username_update.new_name)
-            elif username_update.member_name is None:
-                msg = t.ulog.nick.set(username_update.new_name)
-            elif username_update.new_name is None:
-                msg = t.ulog.nick.cleared(username_update.member_name)
+        def create_embed() -> Embed:
+            embed = Embed(title=t.userlogs, color=Colors.userlog)
+            if isinstance(user, int):
+                embed.set_author(name=str(user))
             else:
-                msg = t.ulog.nick.updated(username_update.member_name, username_update.new_name)
-            out.append((username_update.timestamp, msg))
-
-        if await RoleSettings.get("verified") in {role.id for role in guild.roles}:
-            verification: Verification
-            async for verification in await db.stream(filter_by(Verification, member=user_id)):
-                if verification.accepted:
-                    out.append((verification.timestamp, t.ulog.verification.accepted))
-                else:
-                    out.append((verification.timestamp, t.ulog.verification.revoked))
-
-        responses = await get_userlog_entries(user_id, ctx.author)
-        for response in responses:
-            out += response
-
-        out.sort()
-        embed = Embed(title=t.userlogs, color=Colors.userlog)
-        if isinstance(user, int):
-            embed.set_author(name=str(user))
-        else:
-            embed.set_author(name=f"{user} ({user_id})", icon_url=user.display_avatar.url)
-        for row in out:
-            name = format_dt(row[0], style="D") + " " + format_dt(row[0], style="T")
-            value = row[1]
-            embed.add_field(name=name, value=value, inline=False)
+                embed.set_author(name=f"{user} ({user_id})", icon_url=user.display_avatar.url)
+            return embed
 
+        paginator = UserlogPaginator(UserlogTimeline(sources), create_embed, ctx.author)
         if arg_passed:
-            await send_long_embed(ctx, embed, paginate=True)
+            await paginator.reply(ctx)
         else:
             try:
-                await send_long_embed(ctx.author, embed)
+                await paginator.reply(ctx.author)
             except (Forbidden, HTTPException):
                 raise CommandError(t.could_not_send_dm)
             await ctx.message.add_reaction(name_to_emoji["white_check_mark"])
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Callable, Optional, Union
+
+from discord import ButtonStyle, Embed, Interaction, Member, Message, User, ui
+from discord.abc import Messageable
+from discord.utils import format_dt
+
+from PyDrocsid.command import reply
+from PyDrocsid.embeds import EMPTY_MARKDOWN, EmbedLimits, split_lines
+from PyDrocsid.environment import PAGINATION_TTL
+
+from ...userlog import START, Cursor, UserlogEntry, UserlogTimeline
+
+
+# maximum number of userlog entries per page
+PAGE_SIZE = 10
+
+
+class UserlogButton(ui.Button[ui.View]):
+    def __init__(self, paginator: UserlogPaginator, label: str, style: ButtonStyle, page: int, disabled: bool):
+        super().__init__(label=label, style=style, disabled=disabled or paginator.is_finished())
+
+        self.paginator = paginator
+        self.page = page
+
+    async def callback(self, interaction: Interaction):
+        await interaction.response.defer()
+        await self.paginator.goto_page(self.page)
+
+
+class UserlogPaginator(ui.View):
+    """
+    Pagination of a userlog timeline which only loads the visible page.
+
+    The cursors of all visited pages are kept, so previous pages can be loaded again without loading any entries
+    before them. The total number of pages is unknown, so it is only possible to move one page forward at a time.
+    """
+
+    def __init__(self, timeline: UserlogTimeline, create_embed: Callable[[], Embed], user: Union[User, Member]):
+        super().__init__(timeout=PAGINATION_TTL)
+
+        self.timeline = timeline
+        self.create_embed = create_embed
+        self.user = user
+        self.cursors: list[Cursor] = [START]
+        self.page: int = 0
+        self.has_next: bool = False
+        self.embed: Optional[Embed] = None
+        self.message: Optional[Message] = None
+        self.lock = asyncio.Lock()
+
+    async def load_page(self):
+        entries = await self.timeline.fetch(self.cursors[self.page], PAGE_SIZE + 1)
+
+        embed = self.create_embed()
+        shown: list[UserlogEntry] = []
+        for timestamp, text in entries[:PAGE_SIZE]:
+            parts = split_lines(text, EmbedLimits.FIELD_VALUE) or [EMPTY_MARKDOWN]
+            name = format_dt(timestamp, style="D") + " " + format_dt(timestamp, style="T")
+            size = len(name) + sum(map(len, parts)) + len(EMPTY_MARKDOWN) * (len(parts) - 1)
+            if shown and (len(embed) + size > EmbedLimits.TOTAL or len(embed.fields) + len(parts) > EmbedLimits.FIELDS):
+                break
+
+            for i, part in enumerate(parts):
+                embed.add_field(name=EMPTY_MARKDOWN if i else name, value=part, inline=False)
+            shown.append((timestamp, text))
+
+        self.has_next = len(shown) < len(entries)
+        if self.has_next and self.page + 1 == len(self.cursors):
+            self.cursors.append(self.cursors[self.page].advance(shown))
+
+        self.embed = embed
+
+    def update_buttons(self):
+        self.clear_items()
+        self.add_item(UserlogButton(self, "<<", ButtonStyle.blurple, 0, self.page == 0))
+        self.add_item(UserlogButton(self, "<", ButtonStyle.red, self.page - 1, self.page == 0))
+        self.add_item(UserlogButton(self, str(self.page + 1), ButtonStyle.grey, self.page, True))
+        self.add_item(UserlogButton(self, ">", ButtonStyle.green, self.page + 1, not self.has_next))
+
+    async def reply(self, channel: Union[Message, Messageable]) -> Message:
+        async with self.lock:
+            await self.load_page()
+            self.update_buttons()
+            self.message = await reply(channel, embed=self.embed, view=self)
+            return self.message
+
+    async def goto_page(self, page: int):
+        async with self.lock:
+            self.page = min(max(page, 0), len(self.cursors) - 1)
+            await self.load_page()
+            self.update_buttons()
+            if self.message is not None:
+                await self.message.edit(embed=self.embed, view=self)
+
+    async def on_timeout(self):
+        self.update_buttons()
+        if self.message is not None:
+            await self.message.edit(embed=self.embed, view=self)
+
+    async def interaction_check(self, interaction: Interaction) -> bool:
+        return interaction.user == self.user
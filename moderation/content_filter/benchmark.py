@@ -0,0 +1,334 @@
+"""
+Corpus replay benchmark for the content filter.
+
+Replays a message corpus through ``check_message`` using in-memory fakes for redis, the database and discord
+messages, and reports the throughput and the latency percentiles for a given rule set. Run it from the directory
+which contains the cog library package, e.g.::
+
+    python -m cogs.library.moderation.content_filter.benchmark rules.txt corpus.txt
+    python -m cogs.library.moderation.content_filter.benchmark rules.txt --synthetic 100000 --budget 200
+
+The rules file contains one pattern per line. The corpus file contains one message per line, either as plain
+text or as a JSON string or object with a ``content`` key (e.g. an export of a channel).
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+import string
+from time import perf_counter
+from typing import Any, NamedTuple
+from unittest.mock import patch
+
+from .matcher import CompiledRules
+
+
+class BenchmarkResult(NamedTuple):
+    messages: int
+    matched: int
+    seconds: float
+    latencies: list[float]
+
+    @property
+    def messages_per_second(self) -> float:
+        return self.messages / self.seconds if self.seconds else 0
+
+    def percentile(self, q: float) -> float:
+        if not self.latencies:
+            return 0
+
+        return self.latencies[min(len(self.latencies) - 1, int(q * len(self.latencies)))]
+
+    def summary(self) -> str:
+        return (
+            f"{self.messages} messages ({self.matched} matched) in {self.seconds:.2f} s, "
+            f"{self.messages_per_second:.0f} messages/s\n"
+            f"latency: p50 {self.percentile(0.5) * 1000:.3f} ms, p90 {self.percentile(0.9) * 1000:.3f} ms, "
+            f"p99 {self.percentile(0.99) * 1000:.3f} ms, max {self.percentile(1) * 1000:.3f} ms"
+        )
+
+
+def parse_corpus(text: str) -> list[str]:
+    """Parse a corpus file with one message per line (plain text, JSON strings or JSON objects)."""
+
+    out = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+
+        if line.startswith(("{", '"')):
+            try:
+                message: Any = json.loads(line)
+            except json.JSONDecodeError:
+                pass
+            else:
+                content = str(message.get("content") or "") if isinstance(message, dict) else str(message)
+                if content.strip():
+                    out.append(content)
+                continue
+
+        out.append(line)
+
+    return out
+
+
+def synthetic_corpus(size: int, seed: int = 42) -> list[str]:
+    """Generate a corpus of random chat-like messages of varying length."""
+
+    rng = random.Random(seed)
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(1, 10))) for _ in range(2000)]
+    words += ["https://example.com/" + rng.choice(words) for _ in range(50)] + ["<@123456789012345678>", ":)"]
+
+    lengths = [rng.choice([3, 8, 15, 40, 150]) for _ in range(size)]
+    return [" ".join(rng.choices(words, k=length)) for length in lengths]
+
+
+def replay_rules(regexs: list[str], corpus: list[str]) -> BenchmarkResult:
+    """Evaluate a rule set on each message of a corpus using the compiled matcher only."""
+
+    rules = CompiledRules(regexs)
+    latencies = []
+    matched = 0
+
+    start = perf_counter()
+    for content in corpus:
+        message_start = perf_counter()
+        matched += bool(rules.findall(content))
+        latencies.append(perf_counter() - message_start)
+
+    return BenchmarkResult(len(corpus), matched, perf_counter() - start, sorted(latencies))
+
+
+class FakePipeline:
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+        self.calls: list[Any] = []
+
+    async def __aenter__(self) -> FakePipeline:
+        return self
+
+    async def __aexit__(self, *_: Any) -> None:
+        pass
+
+    def __getattr__(self, name: str) -> Any:
+        async def queue(*args: Any, **kwargs: Any) -> None:
+            self.calls.append(getattr(self.redis, name)(*args, **kwargs))
+
+        return queue
+
+    async def execute(self) -> list[Any]:
+        calls, self.calls = self.calls, []
+        return [await call for call in calls]
+
+
+class FakeRedis:
+    """In-memory replacement for the subset of redis commands used by the content filter."""
+
+    def __init__(self) -> None:
+        self.data: dict[str, Any] = {}
+
+    def pipeline(self) -> FakePipeline:
+        return FakePipeline(self)
+
+    async def get(self, key: str) -> str | None:
+        return None if (value := self.data.get(key)) is None else str(value)
+
+    async def setex(self, key: str, _: int, value: Any) -> None:
+        self.data[key] = str(value)
+
+    async def incr(self, key: str) -> int:
+        return await self.incrby(key, 1)
+
+    async def incrby(self, key: str, amount: int) -> int:
+        self.data[key] = int(self.data.get(key, 0)) + amount
+        return self.data[key]
+
+    async def delete(self, *keys: str) -> int:
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    async def expire(self, key: str, _: int) -> bool:
+        return key in self.data
+
+    async def hgetall(self, key: str) -> dict[str, str]:
+        return {field: str(value) for field, value in self.data.get(key, {}).items()}
+
+    async def hset(
+        self, key: str, field: str | None = None, value: Any = None, mapping: dict[str, Any] | None = None
+    ) -> None:
+        self.data.setdefault(key, {}).update(mapping or {field: value})
+
+    async def hdel(self, key: str, *fields: str) -> int:
+        return sum(self.data.get(key, {}).pop(field, None) is not None for field in fields)
+
+    async def hincrby(self, key: str, field: str, amount: int = 1) -> int:
+        hash_ = self.data.setdefault(key, {})
+        hash_[field] = int(hash_.get(field, 0)) + amount
+        return hash_[field]
+
+    async def hincrbyfloat(self, key: str, field: str, amount: float = 1) -> float:
+        hash_ = self.data.setdefault(key, {})
+        hash_[field] = float(hash_.get(field, 0)) + amount
+        return hash_[field]
+
+    async def sadd(self, key: str, *members: str) -> int:
+        set_ = self.data.setdefault(key, set())
+        added = set(members) - set_
+        set_.update(added)
+        return len(added)
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.mention = f"<@{user_id}>"
+
+    def __str__(self) -> str:
+        return f"{self.name}#0000"
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+        self.mention = f"<#{channel_id}>"
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+
+
+class FakeMessage:
+    def __init__(self, message_id: int, content: str, author: FakeUser, channel: FakeChannel, guild: FakeGuild):
+        self.id = message_id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.deleted = False
+
+    @property
+    def jump_url(self) -> str:
+        return f"https://discord.com/channels/{self.guild.id}/{self.channel.id}/{self.id}"
+
+    async def delete(self) -> None:
+        self.deleted = True
+
+    async def add_reaction(self, _: str) -> None:
+        pass
+
+
+class FakeStats:
+    """Replacement for the live filter statistics, which never requests a profile of a slow message."""
+
+    def __init__(self) -> None:
+        self.messages = 0
+
+    def record_message(self, *_: Any) -> bool:
+        self.messages += 1
+        return False
+
+    def record_profile(self, _: Any) -> None:
+        pass
+
+    async def flush(self) -> None:
+        pass
+
+
+class FakeSink:
+    def __init__(self) -> None:
+        self.violations = 0
+        self.unchecked = 0
+
+    def add(self, _: Any) -> None:
+        self.violations += 1
+
+    def add_unchecked(self, _: Any) -> None:
+        self.unchecked += 1
+
+
+async def replay_check_message(regexs: list[str], corpus: list[str], budget: int = 0) -> BenchmarkResult:
+    """Replay a corpus through check_message, using in-memory fakes instead of redis, the database and discord."""
+
+    import PyDrocsid.settings
+    from PyDrocsid.events import StopEventHandling
+
+    from . import cog, matcher, models, stats
+    from .models import RULES_KEY, VERSION_KEY
+    from .permissions import ContentFilterPermission
+
+    redis = FakeRedis()
+    redis.data[RULES_KEY] = {regex: f"{i}:1" for i, regex in enumerate(regexs, start=1)}
+    redis.data[VERSION_KEY] = 1
+    redis.data["settings:content_filter.time_budget"] = budget
+
+    async def check_permissions(*_: Any) -> bool:
+        return False
+
+    guild = FakeGuild(1)
+    users = [FakeUser(1000 + i) for i in range(100)]
+    channels = [FakeChannel(100 + i) for i in range(10)]
+    sink = FakeSink()
+
+    with (
+        patch.object(cog, "redis", redis),
+        patch.object(matcher, "redis", redis),
+        patch.object(models, "redis", redis),
+        patch.object(stats, "redis", redis),
+        patch.object(PyDrocsid.settings, "redis", redis),
+        patch.object(cog, "violation_sink", sink),
+        patch.object(cog, "filter_stats", FakeStats()),
+        patch.object(ContentFilterPermission, "check_permissions", check_permissions),
+        patch.object(cog, "matcher", matcher.RuleMatcher()),
+    ):
+        # compile the rule set before measuring
+        await cog.matcher.get()
+
+        latencies = []
+        start = perf_counter()
+        for i, content in enumerate(corpus):
+            message = FakeMessage(i, content, users[i % len(users)], channels[i % len(channels)], guild)
+            message_start = perf_counter()
+            try:
+                await cog.check_message(message)  # type: ignore
+            except StopEventHandling:
+                pass
+            latencies.append(perf_counter() - message_start)
+
+        seconds = perf_counter() - start
+
+    return BenchmarkResult(len(corpus), sink.violations, seconds, sorted(latencies))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("rules", help="file with one pattern per line")
+    parser.add_argument("corpus", nargs="?", help="file with one message per line")
+    parser.add_argument("--synthetic", type=int, metavar="N", help="use N generated messages instead of a corpus")
+    parser.add_argument("--budget", type=int, default=0, help="time budget in milliseconds (0 to evaluate inline)")
+    parser.add_argument("--matcher-only", action="store_true", help="only benchmark the compiled matcher")
+    args = parser.parse_args()
+
+    with open(args.rules, encoding="utf-8") as file:
+        regexs = [line for line in file.read().splitlines() if line]
+
+    if args.corpus:
+        with open(args.corpus, encoding="utf-8") as file:
+            corpus = parse_corpus(file.read())
+    else:
+        corpus = synthetic_corpus(args.synthetic or 10000)
+
+    if args.matcher_only:
+        result = replay_rules(regexs, corpus)
+    else:
+        result = asyncio.run(replay_check_message(regexs, corpus, args.budget))
+
+    print(f"{len(regexs)} patterns")
+    print(result.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
 import re
+from time import perf_counter
 
 from discord import Embed, Forbidden, Message
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.ext.commands import CommandError, Context, Converter, UserInputError, guild_only
+from discord.utils import utcnow
 
+from PyDrocsid.async_thread import run_in_thread
 from PyDrocsid.cog import Cog
-from PyDrocsid.command import Confirmation, add_reactions, docs
+from PyDrocsid.command import Confirmation, add_reactions, docs, reply
 from PyDrocsid.database import db, filter_by, select
 from PyDrocsid.embeds import send_long_embed
 from PyDrocsid.emojis import name_to_emoji
@@ -14,11 +17,17 @@ from PyDrocsid.events import StopEventHandling
 from PyDrocsid.redis import redis
 from PyDrocsid.translations import t
 
+from .benchmark import parse_corpus, replay_rules
 from .colors import Colors
+from .matcher import OVER_BUDGET_THRESHOLD, clear_over_budget, get_over_budget, matcher, passes_benchmark
 from .models import BadWord, BadWordPost, sync_redis
 from .permissions import ContentFilterPermission
+from .settings import ContentFilterSettings
+from .sink import UncheckedMessage, Violation, violation_sink
+from .stats import FilterStats, filter_stats, percentile
 from ...contributor import Contributor
-from ...pubsub import get_userlog_entries, send_alert, send_to_changelog
+from ...pubsub import get_userlog_sources, send_to_changelog
+from ...userlog import UserlogSource, query_source
 
 
 tg = t.g
@@ -45,6 +54,9 @@ class RegexConverter(Converter):
         except re.error:
             raise CommandError(t.invalid_regex)
 
+        if not await passes_benchmark(argument):
+            raise CommandError(t.regex_too_slow)
+
         return argument
 
 
@@ -53,15 +65,16 @@ def findall(regex: str, text: str) -> list[str]:
 
 
 async def get_new_matches(message_id: int, matches: set[str]) -> set[str]:
-    new_matches = matches - set(await redis.lrange(key := f"content_filter:alert:{message_id}", 0, -1))
+    key = f"content_filter:alerted:{message_id}"
+    ordered = list(matches)
 
     async with redis.pipeline() as pipe:
-        for match in new_matches:
-            await pipe.lpush(key, match)
+        for match in ordered:
+            await pipe.sadd(key, match)
         await pipe.expire(key, CACHE_TTL)
-        await pipe.execute()
+        *added, _ = await pipe.execute()
 
-    return new_matches
+    return {match for match, new in zip(ordered, added) if new}
 
 
 async def check_message(message: Message) -> None:
@@ -72,71 +85,84 @@ async def check_message(message: Message) -> None:
     if await ContentFilterPermission.bypass.check_permissions(author):
         return
 
-    violation_regexs: set[str] = set()
-    violation_matches: set[str] = set()
-    for regex in await BadWord.get_all_redis():
-        if not (matches := findall(regex, message.content)):
-            continue
+    start = perf_counter()
+    violations: dict[str, list[str]] | None = await matcher.findall(message.content)
+    if filter_stats.record_message(perf_counter() - start, violations):
+        matcher.profile_in_background(message.content, filter_stats.record_profile)
+
+    if violations is None:
+        violation_sink.add_unchecked(
+            UncheckedMessage(message.guild, author, message.channel.id, message.jump_url, matcher.budget)
+        )
+        return
 
-        violation_regexs.add(regex)
-        violation_matches.update(matches)
+    violation_regexs: set[str] = set(violations)
+    violation_matches: set[str] = {match for matches in violations.values() for match in matches}
 
     if not violation_regexs:
         return
 
-    bad_words: list[BadWord] = await db.all(select(BadWord).where(BadWord.regex.in_(violation_regexs)))
-    bad_word_ids: set[int] = {bad_word.id for bad_word in bad_words}
-    delete_message = any(bad_word.delete for bad_word in bad_words)
+    rules: list[tuple[int, bool]] = [rule for regex in violation_regexs if (rule := matcher.rule_info.get(regex))]
+    bad_word_ids: frozenset[int] = frozenset(rule_id for rule_id, _ in rules)
+    delete_message = any(delete for _, delete in rules)
 
     was_deleted = False
     if delete_message:
         try:
             await message.delete()
         except Forbidden:
-            log_text = t.log_forbidden_posted_not_deleted
+            pass
         else:
             was_deleted = True
-            log_text = t.log_forbidden_posted_deleted
-    else:
-        log_text = t.log_forbidden_posted
 
     new_matches: set[str] = await get_new_matches(message.id, violation_matches)
     if new_matches:
-        await send_alert(
-            message.guild,
-            log_text(
-                f"{author.mention} (`@{author}`, {author.id})",
+        violation_sink.add(
+            Violation(
+                message.guild,
+                author,
+                message.channel.id,
                 message.jump_url,
-                message.channel.mention,
-                ", ".join(sorted(new_matches)),
-                ", ".join(map(str, sorted(bad_word_ids))),
-            ),
+                new_matches,
+                bad_word_ids,
+                delete_message,
+                was_deleted,
+                utcnow(),
+            )
         )
 
-    for post in new_matches:
-        await BadWordPost.create(author.id, author.name, message.channel.id, post, was_deleted)
-
     if was_deleted:
         raise StopEventHandling
 
     await message.add_reaction(name_to_emoji["warning"])
 
 
+def format_bad_word_post(post: BadWordPost) -> str:
+    if post.deleted_message:
+        return t.ulog_message_deleted(post.content, post.channel)
+    return t.ulog_message(post.content, post.channel)
+
+
 class ContentFilterCog(Cog, name="Content Filter"):
     CONTRIBUTORS = [Contributor.Infinity, Contributor.Defelo]
 
-    @get_userlog_entries.subscribe
-    async def handle_get_ulog_entries(self, user_id: int, _):
-        out = []
+    async def on_ready(self):
+        try:
+            self.stats_loop.start()
+        except RuntimeError:
+            self.stats_loop.restart()
+
+    def cog_unload(self):
+        self.stats_loop.cancel()
+        violation_sink.flush_soon()
 
-        log: BadWordPost
-        async for log in await db.stream(filter_by(BadWordPost, member=user_id)):
-            if log.deleted_message:
-                out.append((log.timestamp, t.ulog_message_deleted(log.content, log.channel)))
-            else:
-                out.append((log.timestamp, t.ulog_message(log.content, log.channel)))
+    @tasks.loop(minutes=1)
+    async def stats_loop(self):
+        await filter_stats.flush()
 
-        return out
+    @get_userlog_sources.subscribe
+    async def handle_get_userlog_sources(self, user_id: int, _) -> list[UserlogSource]:
+        return [query_source(filter_by(BadWordPost, member=user_id), BadWordPost.timestamp, format_bad_word_post)]
 
     async def on_message(self, message: Message):
         await check_message(message)
@@ -155,14 +181,15 @@ class ContentFilterCog(Cog, name="Content Filter"):
             return
 
         embed = Embed(title=t.bad_word_list_header, colour=Colors.ContentFilter)
+        over_budget: dict[str, int] = await get_over_budget()
 
         reg: BadWord
         async for reg in await db.stream(select(BadWord)):
-            embed.add_field(
-                name=t.embed_field_name(reg.id, reg.description),
-                value=t.embed_field_value(reg.regex, t.delete if reg.delete else t.not_delete),
-                inline=False,
-            )
+            value = t.embed_field_value(reg.regex, t.delete if reg.delete else t.not_delete)
+            if (count := over_budget.get(reg.regex, 0)) >= OVER_BUDGET_THRESHOLD:
+                value += "\n" + t.over_budget(cnt=count)
+
+            embed.add_field(name=t.embed_field_name(reg.id, reg.description), value=value, inline=False)
 
         if not embed.fields:
             embed.colour = Colors.error
@@ -183,6 +210,7 @@ class ContentFilterCog(Cog, name="Content Filter"):
             raise CommandError(t.description_length)
 
         await BadWord.create(regex, description, delete)
+        matcher.invalidate()
         await add_reactions(ctx.message, "white_check_mark")
         await send_to_changelog(ctx.guild, t.log_content_filter_added(regex, ctx.author.mention))
 
@@ -196,6 +224,9 @@ class ContentFilterCog(Cog, name="Content Filter"):
             return
 
         await pattern.remove()
+        await clear_over_budget(pattern.regex)
+        await FilterStats.clear(pattern.regex)
+        matcher.invalidate()
         await add_reactions(ctx.message, "white_check_mark")
         await send_to_changelog(ctx.guild, t.log_content_filter_removed(pattern.regex, ctx.author.mention))
 
@@ -231,6 +262,9 @@ class ContentFilterCog(Cog, name="Content Filter"):
         old = pattern.regex
         pattern.regex = new_regex
         await sync_redis()
+        await clear_over_budget(old)
+        await FilterStats.clear(old)
+        matcher.invalidate()
 
         await add_reactions(ctx.message, "white_check_mark")
         await send_to_changelog(ctx.guild, t.log_regex_updated(old, pattern.regex))
@@ -240,10 +274,52 @@ class ContentFilterCog(Cog, name="Content Filter"):
     async def delete_message(self, ctx: Context, pattern: ContentFilterConverter, delete: bool):
         pattern: BadWord
         pattern.delete = delete
+        await sync_redis()
+        matcher.invalidate()
 
         await add_reactions(ctx.message, "white_check_mark")
         await send_to_changelog(ctx.guild, t.log_delete_updated(pattern.delete, pattern.regex))
 
+    @content_filter.command(name="budget", aliases=["b"])
+    @ContentFilterPermission.write.check
+    @docs(t.commands.budget)
+    async def budget(self, ctx: Context, milliseconds: int):
+        if milliseconds < 0:
+            raise CommandError(t.invalid_budget)
+
+        await ContentFilterSettings.time_budget.set(milliseconds)
+        matcher.invalidate()
+
+        description = t.budget_set(milliseconds) if milliseconds else t.budget_disabled
+        await reply(ctx, embed=Embed(title=t.content_filter, description=description, colour=Colors.ContentFilter))
+        await send_to_changelog(ctx.guild, description)
+
+    @content_filter.command(name="stats", aliases=["s"])
+    @ContentFilterPermission.read.check
+    @docs(t.commands.stats)
+    async def stats(self, ctx: Context):
+        await filter_stats.flush()
+
+        bad_words: list[BadWord] = await BadWord.get_all_db()
+        messages, rules, latency = await FilterStats.load([bad_word.regex for bad_word in bad_words])
+
+        embed = Embed(title=t.stats_header, colour=Colors.ContentFilter)
+        p50, p99 = percentile(latency, 0.5), percentile(latency, 0.99)
+        embed.description = t.stats_summary(
+            messages, f"{p50 * 1000:.2f}" if p50 is not None else "-", f"{p99 * 1000:.2f}" if p99 is not None else "-"
+        )
+
+        for bad_word in sorted(bad_words, key=lambda b: rules[b.regex].cost, reverse=True):
+            rule = rules[bad_word.regex]
+            last_hit = f"<t:{int(rule.last_hit)}:R>" if rule.last_hit is not None else t.never
+            embed.add_field(
+                name=t.embed_field_name(bad_word.id, bad_word.description),
+                value=t.stats_field_value(bad_word.regex, f"{rule.cost * 1000:.1f}", rule.hits, last_hit),
+                inline=False,
+            )
+
+        await send_long_embed(ctx, embed, paginate=True, max_fields=6)
+
     @content_filter.command(name="check", aliases=["c"])
     @ContentFilterPermission.read.check
     @docs(t.commands.check)
@@ -270,3 +346,35 @@ class ContentFilterCog(Cog, name="Content Filter"):
         embed.add_field(name=t.matches, value="\n".join(out) or t.no_matches)
 
         await send_long_embed(ctx, embed, paginate=True)
+
+    @content_filter.command(name="benchmark", aliases=["bench"])
+    @ContentFilterPermission.write.check
+    @docs(t.commands.benchmark)
+    async def benchmark(self, ctx: Context, pattern: ContentFilterConverter | int | RegexConverter):
+        regexs: list[str]
+        if isinstance(pattern, BadWord):
+            regexs = [pattern.regex]
+        elif isinstance(pattern, str):
+            regexs = [pattern]
+        elif pattern == -1:
+            regexs = await BadWord.get_all_redis()
+        else:
+            raise CommandError(t.invalid_pattern)
+
+        if not ctx.message.attachments:
+            raise CommandError(t.no_corpus)
+
+        corpus = parse_corpus((await ctx.message.attachments[0].read()).decode("utf-8", errors="replace"))
+        result = await run_in_thread(replay_rules)(regexs, corpus)
+
+        embed = Embed(title=t.benchmark_header, colour=Colors.ContentFilter)
+        embed.add_field(name=t.patterns, value=str(len(regexs)))
+        embed.add_field(name=t.messages, value=t.messages_matched(result.messages, result.matched))
+        embed.add_field(name=t.throughput, value=t.messages_per_second(f"{result.messages_per_second:.0f}"))
+        embed.add_field(
+            name=t.latency,
+            value=t.latency_percentiles(*(f"{result.percentile(q) * 1000:.3f}" for q in [0.5, 0.9, 0.99, 1])),
+            inline=False,
+        )
+
+        await reply(ctx, embed=embed)
@@ -0,0 +1,367 @@
+from __future__ import annotations
+
+import asyncio
+import re
+from collections import OrderedDict
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Connection
+from time import monotonic, perf_counter
+from typing import Any, Callable, TypeVar
+
+from PyDrocsid.logger import get_logger
+from PyDrocsid.redis import redis
+
+from .models import BadWord
+from .settings import ContentFilterSettings
+
+
+T = TypeVar("T")
+
+logger = get_logger(__name__)
+
+# interval (in seconds) in which the rule set version is compared with the one stored in redis
+VERSION_CHECK_INTERVAL = 10
+
+# number of worker processes used to evaluate rules if a time budget is configured
+WORKERS = 2
+
+# redis hash which counts how often each pattern has exceeded the time budget
+OVER_BUDGET_KEY = "content_filter:over_budget"
+
+# number of times a pattern has to exceed the time budget to be flagged in the list of patterns
+OVER_BUDGET_THRESHOLD = 3
+
+# time (in seconds) a new pattern may take for all pathological inputs
+BENCHMARK_BUDGET = 1
+BENCHMARK_LENGTH = 2000
+
+# time (in seconds) the profiling of a single sampled message may take
+PROFILE_BUDGET = 2
+
+# patterns which cannot be embedded into the combined pattern without changing their semantics
+_GLOBAL_FLAGS = re.compile(r"\(\?[aiLmsux]+\)")
+_NUMBERED_REFERENCE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+
+def is_combinable(regex: str) -> bool:
+    """Return whether a pattern can be embedded into the combined pattern of a rule set."""
+
+    return not (re.compile(regex).groupindex or _GLOBAL_FLAGS.search(regex) or _NUMBERED_REFERENCE.search(regex))
+
+
+# maximum number of patterns of a node of the pre-filter tree which are evaluated on their own if the node matches
+LEAF_SIZE = 4
+
+
+class PrefilterNode:
+    """
+    Node of the pre-filter tree of a rule set.
+
+    The pattern of a node is the alternation of all patterns below it, which matches somewhere in a message if and
+    only if at least one of these patterns does. The two children of a node each cover one half of its patterns.
+    """
+
+    def __init__(self, regexs: list[str], rules: list[int]):
+        self.rules: list[int] = rules
+        self.pattern: re.Pattern[str] = re.compile("|".join(f"(?:{regexs[i]})" for i in rules))
+        self.children: list[PrefilterNode] = []
+        if len(rules) > LEAF_SIZE:
+            middle = len(rules) // 2
+            self.children = [PrefilterNode(regexs, rules[:middle]), PrefilterNode(regexs, rules[middle:])]
+
+    def find_candidates(self, text: str, out: set[int], pos: int = 0) -> None:
+        """Add the patterns of all leaves below this node which contain a pattern matching at or after pos."""
+
+        if (match := self.pattern.search(text, pos)) is None:
+            return
+
+        if not self.children:
+            out.update(self.rules)
+            return
+
+        # no pattern below this node matches before its first match
+        for child in self.children:
+            child.find_candidates(text, out, match.start())
+
+
+class CompiledRules:
+    """
+    A compiled content filter rule set.
+
+    All combinable patterns are joined into a tree of alternations. A message without any match only costs a single
+    scan with the alternation of all patterns, otherwise only the subtrees whose alternation matches are searched,
+    so only a few patterns next to the matching ones are evaluated on their own. Each of them is evaluated with its
+    own scan, so overlapping matches of different rules are reported exactly like before.
+    """
+
+    def __init__(self, regexs: list[str]):
+        self.regexs: list[str] = regexs
+        self.compiled: list[re.Pattern[str]] = [re.compile(regex) for regex in regexs]
+
+        combined = [i for i, regex in enumerate(regexs) if is_combinable(regex)]
+        self.separate: list[int] = sorted(set(range(len(regexs))) - set(combined))
+        self.prefilter: PrefilterNode | None = PrefilterNode(regexs, combined) if combined else None
+
+    def findall(self, text: str) -> dict[str, list[str]]:
+        """Return a dictionary which maps each matching pattern to the list of its matches."""
+
+        candidates: set[int] = set(self.separate)
+        if self.prefilter is not None:
+            self.prefilter.find_candidates(text, candidates)
+
+        out: dict[str, list[str]] = {}
+        for i in sorted(candidates):
+            if matches := [match[0] for match in self.compiled[i].finditer(text)]:
+                out[self.regexs[i]] = matches
+
+        return out
+
+    def profile(self, text: str) -> dict[str, float]:
+        """Return the time (in seconds) each pattern takes to scan the given text on its own."""
+
+        out: dict[str, float] = {}
+        for regex, pattern in zip(self.regexs, self.compiled):
+            start = perf_counter()
+            for _ in pattern.finditer(text):
+                pass
+            out[regex] = perf_counter() - start
+
+        return out
+
+
+# number of rule set versions whose compiled rule sets are kept in memory by each worker process
+WORKER_CACHE_SIZE = 2
+
+_worker_rules: OrderedDict[int | None, CompiledRules] = OrderedDict()
+
+
+def _get_worker_rules(version: int | None, regexs: list[str]) -> CompiledRules:
+    """Return the compiled rule set of the given version, which is kept in memory by each worker process."""
+
+    if (rules := _worker_rules.get(version)) is None or rules.regexs != regexs:
+        rules = _worker_rules[version] = CompiledRules(regexs)
+    _worker_rules.move_to_end(version)
+
+    while len(_worker_rules) > WORKER_CACHE_SIZE:
+        _worker_rules.popitem(last=False)
+
+    return rules
+
+
+def _evaluate(version: int | None, regexs: list[str], text: str) -> dict[str, list[str]]:
+    return _get_worker_rules(version, regexs).findall(text)
+
+
+def _profile(version: int | None, regexs: list[str], text: str) -> dict[str, float]:
+    return _get_worker_rules(version, regexs).profile(text)
+
+
+def _search(regex: str, text: str) -> None:
+    for _ in re.finditer(regex, text):
+        pass
+
+
+def _benchmark(regex: str) -> None:
+    pattern = re.compile(regex)
+    for char in sorted({c for c in regex if c.isalnum()} | set("a0 .-_")):
+        for suffix in ["", "\0"]:
+            pattern.search(char * BENCHMARK_LENGTH + suffix)
+
+
+def _worker_main(conn: Connection) -> None:
+    while True:
+        try:
+            func, args = conn.recv()
+        except EOFError:
+            return
+
+        try:
+            conn.send((True, func(*args)))
+        except Exception as e:
+            conn.send((False, e))
+
+
+class _Worker:
+    """A single worker process which evaluates one function call at a time."""
+
+    def __init__(self):
+        self.conn, child = Pipe()
+        self.process = Process(target=_worker_main, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+
+    async def run(self, budget: float, func: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_running_loop()
+        readable: asyncio.Future[None] = loop.create_future()
+
+        self.conn.send((func, args))
+        loop.add_reader(self.conn.fileno(), lambda: readable.done() or readable.set_result(None))
+        try:
+            await asyncio.wait_for(readable, budget)
+        finally:
+            loop.remove_reader(self.conn.fileno())
+
+        ok, result = self.conn.recv()
+        if not ok:
+            raise result
+        return result
+
+    def kill(self):
+        self.process.kill()
+        self.conn.close()
+
+
+class WorkerPool:
+    """
+    Pool of worker processes which can run functions with a time budget.
+
+    A worker stuck in catastrophic backtracking cannot be cancelled, so a worker which exceeds the budget is killed
+    and replaced on demand. All other workers and the calls they are currently running are not affected.
+    """
+
+    def __init__(self, size: int):
+        self.size: int = size
+        self.idle: list[_Worker] = []
+        self.semaphore: asyncio.Semaphore | None = None
+
+    async def run(self, budget: float, func: Callable[..., T], *args: Any) -> T:
+        """
+        Run a function in a worker process and wait at most budget seconds for the result.
+
+        :raises asyncio.TimeoutError: if the function did not finish in time or the worker process has died
+        """
+
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.size)
+
+        async with self.semaphore:
+            worker = self.idle.pop() if self.idle else _Worker()
+            try:
+                result = await worker.run(budget, func, *args)
+            except (EOFError, OSError):
+                worker.kill()
+                raise asyncio.TimeoutError
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                worker.kill()
+                raise
+            except Exception:
+                self.idle.append(worker)
+                raise
+
+            self.idle.append(worker)
+            return result
+
+
+# workers which evaluate the rules on live messages
+check_pool = WorkerPool(WORKERS)
+
+# worker which attributes budget violations to patterns and benchmarks new patterns, so these never delay or abort
+# the evaluation of live messages
+analysis_pool = WorkerPool(1)
+
+# worker which profiles sampled messages, so a slow pattern never delays or aborts the evaluation of live messages
+profile_pool = WorkerPool(1)
+
+
+async def passes_benchmark(regex: str) -> bool:
+    """Return whether a pattern can be evaluated on a set of pathological inputs within the benchmark budget."""
+
+    try:
+        await analysis_pool.run(BENCHMARK_BUDGET, _benchmark, regex)
+    except asyncio.TimeoutError:
+        return False
+
+    return True
+
+
+async def get_over_budget() -> dict[str, int]:
+    """Return how often each pattern has exceeded the time budget."""
+
+    return {regex: int(count) for regex, count in (await redis.hgetall(OVER_BUDGET_KEY)).items()}
+
+
+async def clear_over_budget(regex: str) -> None:
+    await redis.hdel(OVER_BUDGET_KEY, regex)
+
+
+class RuleMatcher:
+    """Keeps the compiled rule set in memory and rebuilds it only if the rule set version has changed."""
+
+    def __init__(self) -> None:
+        self.rules: CompiledRules = CompiledRules([])
+        self.rule_info: dict[str, tuple[int, bool]] = {}
+        self.version: int | None = None
+        self.checked_at: float | None = None
+        self.budget: int = 0
+        self.attribution: asyncio.Task[None] | None = None
+        self.profiling: asyncio.Task[None] | None = None
+
+    def invalidate(self) -> None:
+        """Force a version check on the next access (e.g. after the rule set has been changed locally)."""
+
+        self.checked_at = None
+
+    async def get(self) -> CompiledRules:
+        if self.checked_at is not None and monotonic() - self.checked_at < VERSION_CHECK_INTERVAL:
+            return self.rules
+
+        version = await BadWord.get_version()
+        if version != self.version or self.checked_at is None:
+            self.rule_info = await BadWord.get_rules_redis()
+            self.rules = CompiledRules(list(self.rule_info))
+            self.version = version
+
+        self.budget = await ContentFilterSettings.time_budget.get()
+        self.checked_at = monotonic()
+        return self.rules
+
+    async def findall(self, text: str) -> dict[str, list[str]] | None:
+        """
+        Evaluate all rules on the given text.
+
+        If a time budget is configured, the rules are evaluated in a worker process.
+        If the budget is exceeded, None is returned and the responsible patterns are determined in the background.
+        """
+
+        rules = await self.get()
+        if self.budget <= 0:
+            return rules.findall(text)
+
+        try:
+            return await check_pool.run(self.budget / 1000, _evaluate, self.version, rules.regexs, text)
+        except asyncio.TimeoutError:
+            if self.attribution is None or self.attribution.done():
+                self.attribution = asyncio.create_task(self.find_slow_rules(rules.regexs, text))
+            return None
+
+    async def profile(self, text: str) -> dict[str, float] | None:
+        """Measure the evaluation time of each pattern, or return None if the profiling budget has been exceeded."""
+
+        rules = await self.get()
+        try:
+            return await profile_pool.run(PROFILE_BUDGET, _profile, self.version, rules.regexs, text)
+        except asyncio.TimeoutError:
+            return None
+
+    def profile_in_background(self, text: str, callback: Callable[[dict[str, float]], None]) -> None:
+        """Profile the given text in the background, unless the previous profiling is still running."""
+
+        if self.profiling is None or self.profiling.done():
+            self.profiling = asyncio.create_task(self._profile_in_background(text, callback))
+
+    async def _profile_in_background(self, text: str, callback: Callable[[dict[str, float]], None]) -> None:
+        if (profile := await self.profile(text)) is not None:
+            callback(profile)
+
+    async def find_slow_rules(self, regexs: list[str], text: str) -> None:
+        """Evaluate each pattern separately and count those which exceed the time budget."""
+
+        for regex in regexs:
+            try:
+                await analysis_pool.run(self.budget / 1000, _search, regex, text)
+            except asyncio.TimeoutError:
+                logger.warning("content filter pattern exceeded the time budget: %s", regex)
+                await redis.hincrby(OVER_BUDGET_KEY, regex, 1)
+
+
+matcher = RuleMatcher()
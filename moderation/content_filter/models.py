@@ -4,26 +4,33 @@ from datetime import datetime
 from typing import Union
 
 from discord.utils import utcnow
-from sqlalchemy import BigInteger, Boolean, Column, Integer, Text
+from sqlalchemy import BigInteger, Boolean, Column, Integer, Text, insert
 
 from PyDrocsid.database import Base, UTCDateTime, db, select
 from PyDrocsid.environment import CACHE_TTL
 from PyDrocsid.redis import redis
 
 
+RULES_KEY = "content_filter:rules"
+VERSION_KEY = "content_filter:version"
+
+
 async def sync_redis() -> list[str]:
     out = []
 
     async with redis.pipeline() as pipe:
-        await pipe.delete(key := "content_filter")
+        await pipe.delete(RULES_KEY)
 
         regex: BadWord
         async for regex in await db.stream(select(BadWord)):
             out.append(regex.regex)
-            await pipe.lpush(key, regex.regex)
+            await pipe.hset(RULES_KEY, regex.regex, f"{regex.id}:{int(regex.delete)}")
+
+        await pipe.hset(RULES_KEY, "", "")
+        await pipe.expire(RULES_KEY, CACHE_TTL)
 
-        await pipe.lpush(key, "")
-        await pipe.expire(key, CACHE_TTL)
+        # bump the rule set version so compiled matchers are rebuilt
+        await pipe.incr(VERSION_KEY)
 
         await pipe.execute()
 
@@ -52,10 +59,27 @@ class BadWord(Base):
 
     @staticmethod
     async def get_all_redis() -> list[str]:
-        if out := await redis.lrange("content_filter", 0, -1):
-            return [x for x in out if x]
+        return list(await BadWord.get_rules_redis())
+
+    @staticmethod
+    async def get_rules_redis() -> dict[str, tuple[int, bool]]:
+        """Return a dictionary which maps each pattern to the id of its rule and whether to delete matching messages."""
+
+        if not (out := await redis.hgetall(RULES_KEY)):
+            await sync_redis()
+            out = await redis.hgetall(RULES_KEY)
 
-        return await sync_redis()
+        rules = {}
+        for regex, value in out.items():
+            if regex:
+                rule_id, delete = value.split(":")
+                rules[regex] = int(rule_id), delete == "1"
+
+        return rules
+
+    @staticmethod
+    async def get_version() -> int:
+        return int(await redis.get(VERSION_KEY) or 0)
 
     @staticmethod
     async def get_all_db() -> list[BadWord]:
@@ -85,3 +109,26 @@ class BadWordPost(Base):
         )
         await db.add(row)
         return row
+
+    @staticmethod
+    async def create_many(posts: list[tuple[int, str, int, str, bool, datetime]]) -> None:
+        """Insert multiple posts using a single multi-row insert statement."""
+
+        if not posts:
+            return
+
+        await db.exec(
+            insert(BadWordPost).values(
+                [
+                    {
+                        "member": member,
+                        "member_name": member_name,
+                        "channel": channel,
+                        "content": content,
+                        "deleted_message": deleted,
+                        "timestamp": timestamp,
+                    }
+                    for member, member_name, channel, content, deleted, timestamp in posts
+                ]
+            )
+        )
@@ -0,0 +1,5 @@
+from PyDrocsid.settings import Settings
+
+
+class ContentFilterSettings(Settings):
+    time_budget = 0
@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import asyncio
+from collections import Counter
+from datetime import datetime
+from typing import NamedTuple
+
+from discord import Guild, Member
+
+from PyDrocsid.database import db_context
+from PyDrocsid.logger import get_logger
+from PyDrocsid.translations import t
+
+from .models import BadWordPost
+from ...pubsub import send_alert
+
+
+logger = get_logger(__name__)
+
+t = t.content_filter
+
+# time (in seconds) for which violations are collected before they are written and reported
+WINDOW = 5
+
+# maximum number of message links in a summary of unchecked messages
+MAX_UNCHECKED_LINKS = 20
+
+
+class Violation(NamedTuple):
+    guild: Guild
+    author: Member
+    channel_id: int
+    jump_url: str
+    matches: set[str]
+    rule_ids: frozenset[int]
+    delete: bool
+    deleted: bool
+    timestamp: datetime
+
+
+class UncheckedMessage(NamedTuple):
+    guild: Guild
+    author: Member
+    channel_id: int
+    jump_url: str
+    budget: int
+
+
+class ViolationSink:
+    """
+    Collects content filter violations for a short window.
+
+    The posts of all violations are inserted at once and all violations of an author are reported in a single
+    alert which lists the number of violations per rule, so a raid does not cause one insert and one alert per
+    message. Messages which could not be checked within the time budget are reported in a single alert per window
+    and guild.
+    """
+
+    def __init__(self) -> None:
+        self.violations: list[Violation] = []
+        self.unchecked: list[UncheckedMessage] = []
+        self.task: asyncio.Task[None] | None = None
+        self.flush_requested = asyncio.Event()
+
+    def add(self, violation: Violation) -> None:
+        self.violations.append(violation)
+        self.schedule()
+
+    def add_unchecked(self, message: UncheckedMessage) -> None:
+        self.unchecked.append(message)
+        self.schedule()
+
+    def schedule(self) -> None:
+        if self.task is None:
+            self.task = asyncio.create_task(self.flush_later())
+
+    def flush_soon(self) -> None:
+        """Flush the collected violations without waiting for the end of the window (e.g. on cog unload)."""
+
+        if self.violations or self.unchecked:
+            self.flush_requested.set()
+            self.schedule()
+
+    async def flush_later(self) -> None:
+        try:
+            await asyncio.wait_for(self.flush_requested.wait(), WINDOW)
+        except asyncio.TimeoutError:
+            pass
+
+        self.flush_requested.clear()
+        try:
+            await self.flush()
+        finally:
+            self.task = None
+            if self.violations or self.unchecked:
+                # collected while flushing
+                self.schedule()
+
+    async def flush(self) -> None:
+        # the alerts may load settings from the database, so they need a session as well
+        async with db_context():
+            await self._flush()
+
+    async def _flush(self) -> None:
+        unchecked, self.unchecked = self.unchecked, []
+        unchecked_groups: dict[int, list[UncheckedMessage]] = {}
+        for message in unchecked:
+            unchecked_groups.setdefault(message.guild.id, []).append(message)
+        for group in unchecked_groups.values():
+            await send_alert(group[0].guild, format_unchecked_alert(group))
+
+        violations, self.violations = self.violations, []
+        if not violations:
+            return
+
+        # the alerts are sent even if the violations could not be saved, so no violation goes unnoticed
+        try:
+            async with db_context():
+                await BadWordPost.create_many(
+                    [
+                        (v.author.id, v.author.name, v.channel_id, match, v.deleted, v.timestamp)
+                        for v in violations
+                        for match in v.matches
+                    ]
+                )
+        except Exception:
+            logger.exception("could not save %d content filter violations", len(violations))
+
+        groups: dict[tuple[int, int], list[Violation]] = {}
+        for violation in violations:
+            groups.setdefault((violation.guild.id, violation.author.id), []).append(violation)
+
+        for group in groups.values():
+            await send_alert(group[0].guild, format_alert(group))
+
+
+def format_alert(violations: list[Violation]) -> str:
+    first = violations[0]
+    author = f"{first.author.mention} (`@{first.author}`, {first.author.id})"
+    matches = ", ".join(sorted({match for v in violations for match in v.matches}))
+
+    if len(violations) == 1:
+        rule_ids = ", ".join(map(str, sorted(first.rule_ids)))
+        if not first.delete:
+            log_text = t.log_forbidden_posted
+        elif first.deleted:
+            log_text = t.log_forbidden_posted_deleted
+        else:
+            log_text = t.log_forbidden_posted_not_deleted
+
+        return log_text(author, first.jump_url, f"<#{first.channel_id}>", matches, rule_ids)
+
+    channels = ", ".join(dict.fromkeys(f"<#{v.channel_id}>" for v in violations))
+    deleted = sum(v.deleted for v in violations)
+    rule_counts = Counter(rule_id for v in violations for rule_id in v.rule_ids)
+    rule_ids = ", ".join(t.rule_count(rule_id, cnt=rule_counts[rule_id]) for rule_id in sorted(rule_counts))
+    out = t.log_forbidden_posted_summary(author, len(violations), channels, matches, rule_ids, deleted)
+    if not_deleted := sum(v.delete and not v.deleted for v in violations):
+        out += t.log_forbidden_posted_summary_not_deleted(cnt=not_deleted)
+
+    return out
+
+
+def format_unchecked_alert(messages: list[UncheckedMessage]) -> str:
+    first = messages[0]
+    if len(messages) == 1:
+        author = f"{first.author.mention} (`@{first.author}`, {first.author.id})"
+        return t.log_unchecked(author, first.jump_url, f"<#{first.channel_id}>", first.budget)
+
+    channels = ", ".join(dict.fromkeys(f"<#{m.channel_id}>" for m in messages))
+    authors = ", ".join(dict.fromkeys(m.author.mention for m in messages))
+    links = " ".join(f"[{i}]({m.jump_url})" for i, m in enumerate(messages[:MAX_UNCHECKED_LINKS], 1))
+    return t.log_unchecked_summary(len(messages), authors, channels, first.budget, links)
+
+
+violation_sink = ViolationSink()
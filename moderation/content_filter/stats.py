@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import math
+import time
+from collections import Counter, defaultdict
+from typing import NamedTuple
+
+from PyDrocsid.redis import redis
+
+
+# every n-th message is used to measure the evaluation time of each pattern
+PROFILE_INTERVAL = 100
+
+# number of latency histogram buckets per power of two (each bucket covers a factor of about 1.19)
+BUCKETS_PER_OCTAVE = 4
+
+MESSAGES_KEY = "content_filter:stats:messages"
+HITS_KEY = "content_filter:stats:hits"
+COST_KEY = "content_filter:stats:cost"
+LAST_HIT_KEY = "content_filter:stats:last_hit"
+LATENCY_KEY = "content_filter:stats:latency"
+
+
+class RuleStats(NamedTuple):
+    hits: int
+    cost: float
+    last_hit: float | None
+
+
+def latency_bucket(seconds: float) -> int:
+    return max(0, round(math.log2(max(seconds * 1e6, 1)) * BUCKETS_PER_OCTAVE))
+
+
+def percentile(histogram: dict[int, int], q: float) -> float | None:
+    """Return the q-quantile (in seconds) of a latency histogram."""
+
+    if not (total := sum(histogram.values())):
+        return None
+
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen >= q * total:
+            return 2 ** (bucket / BUCKETS_PER_OCTAVE) / 1e6
+
+    return None
+
+
+class FilterStats:
+    """
+    In-memory counters for the content filter, which are flushed to redis in batches.
+
+    The number of hits and the time of the last hit are recorded for every message. As measuring each pattern
+    separately would defeat the purpose of the combined pattern, the evaluation time of each pattern is only
+    measured for every n-th message and extrapolated accordingly.
+    """
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.messages: int = 0
+        self.hits: Counter[str] = Counter()
+        self.cost: defaultdict[str, float] = defaultdict(float)
+        self.last_hit: dict[str, float] = {}
+        self.latency: Counter[int] = Counter()
+
+    def record_message(self, latency: float, violations: dict[str, list[str]] | None) -> bool:
+        """Record a checked message and return whether this message should be profiled."""
+
+        self.messages += 1
+        self.latency[latency_bucket(latency)] += 1
+
+        now = time.time()
+        for regex in violations or ():
+            self.hits[regex] += 1
+            self.last_hit[regex] = now
+
+        return self.messages % PROFILE_INTERVAL == 1
+
+    def record_profile(self, profile: dict[str, float]) -> None:
+        for regex, seconds in profile.items():
+            self.cost[regex] += seconds * PROFILE_INTERVAL
+
+    async def flush(self) -> None:
+        if not self.messages:
+            return
+
+        messages, hits, cost, last_hit, latency = self.messages, self.hits, self.cost, self.last_hit, self.latency
+        self.reset()
+
+        async with redis.pipeline() as pipe:
+            await pipe.incrby(MESSAGES_KEY, messages)
+            for regex, count in hits.items():
+                await pipe.hincrby(HITS_KEY, regex, count)
+            for regex, seconds in cost.items():
+                await pipe.hincrbyfloat(COST_KEY, regex, seconds)
+            if last_hit:
+                await pipe.hset(LAST_HIT_KEY, mapping=last_hit)
+            for bucket, count in latency.items():
+                await pipe.hincrby(LATENCY_KEY, str(bucket), count)
+
+            await pipe.execute()
+
+    @staticmethod
+    async def load(regexs: list[str]) -> tuple[int, dict[str, RuleStats], dict[int, int]]:
+        """Return the number of checked messages, the statistics of the given patterns and the latency histogram."""
+
+        async with redis.pipeline() as pipe:
+            await pipe.get(MESSAGES_KEY)
+            await pipe.hgetall(HITS_KEY)
+            await pipe.hgetall(COST_KEY)
+            await pipe.hgetall(LAST_HIT_KEY)
+            await pipe.hgetall(LATENCY_KEY)
+            messages, hits, cost, last_hit, latency = await pipe.execute()
+
+        rules = {
+            regex: RuleStats(
+                int(hits.get(regex, 0)),
+                float(cost.get(regex, 0)),
+                float(last_hit[regex]) if regex in last_hit else None,
+            )
+            for regex in regexs
+        }
+
+        return int(messages or 0), rules, {int(bucket): int(count) for bucket, count in latency.items()}
+
+    @staticmethod
+    async def clear(regex: str) -> None:
+        async with redis.pipeline() as pipe:
+            for key in [HITS_KEY, COST_KEY, LAST_HIT_KEY]:
+                await pipe.hdel(key, regex)
+            await pipe.execute()
+
+
+filter_stats = FilterStats()
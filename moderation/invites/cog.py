@@ -1,13 +1,13 @@
+import asyncio
 import re
-from typing import Optional
+from typing import Iterable, NamedTuple, Optional
+from urllib.parse import urlsplit
 
-import requests
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector, TooManyRedirects
 from discord import Embed, Forbidden, Guild, HTTPException, Invite, Member, Message, NotFound
 from discord.ext import commands
 from discord.ext.commands import CommandError, Context, Converter, UserInputError, guild_only
-from urllib3.exceptions import LocationParseError
 
-from PyDrocsid.async_thread import run_in_thread
 from PyDrocsid.cog import Cog
 from PyDrocsid.command import Confirmation, optional_permissions, reply
 from PyDrocsid.database import db, filter_by, select
@@ -16,13 +16,17 @@ from PyDrocsid.emojis import name_to_emoji
 from PyDrocsid.events import StopEventHandling
 from PyDrocsid.logger import get_logger
 from PyDrocsid.prefix import get_prefix
+from PyDrocsid.redis import redis
 from PyDrocsid.translations import t
 
 from .colors import Colors
-from .models import AllowedInvite, IllegalInvitePost, InviteLog
+from .models import AllowedInvite, IllegalInvitePost, InviteLog, RedirectorDomain
 from .permissions import InvitesPermission
+from .settings import InvitesSettings
 from ...contributor import Contributor
-from ...pubsub import get_userlog_entries, send_alert, send_to_changelog
+from ...pubsub import get_userlog_sources, send_alert, send_to_changelog
+from ...urls import get_message_urls
+from ...userlog import UserlogSource, query_source
 
 
 tg = t.g
@@ -30,6 +34,100 @@ t = t.invites
 
 logger = get_logger(__name__)
 
+# maximum number of urls of a single message which are resolved concurrently
+MAX_CONCURRENT_RESOLUTIONS = 5
+
+# maximum time (in seconds) to resolve all urls of a single message
+RESOLVE_DEADLINE = 10
+
+# upper bound of the configurable maximum number of redirects which are followed to resolve a single url
+MAX_REDIRECTS_LIMIT = 30
+
+# result of urls whose redirect chain is longer than the maximum number of redirects (never a valid invite code)
+TOO_MANY_REDIRECTS = "*"
+
+# time (in seconds) for which resolved urls and invite codes are cached
+URL_CACHE_TTL = 24 * 60 * 60
+URL_ERROR_CACHE_TTL = 5 * 60
+INVITE_CACHE_TTL = 60 * 60
+
+# domains (or domain/path prefixes) which are known to redirect to arbitrary urls and are therefore always resolved,
+# further domains can be added using the invites redirector command
+REDIRECTOR_DOMAINS = frozenset(
+    {
+        "bit.ly",
+        "buff.ly",
+        "cutt.ly",
+        "discord.io",
+        "discord.link",
+        "discord.me",
+        "disboard.org",
+        "dsc.gg",
+        "goo.gl",
+        "google.com/url",
+        "href.li",
+        "invite.gg",
+        "is.gd",
+        "l.facebook.com",
+        "linktr.ee",
+        "medium.com/r",
+        "out.reddit.com",
+        "ow.ly",
+        "rb.gy",
+        "rebrand.ly",
+        "s.id",
+        "shorturl.at",
+        "t.co",
+        "t.ly",
+        "tiny.cc",
+        "tinyurl.com",
+        "top.gg",
+        "twitter.com/i",
+        "v.gd",
+        "youtube.com/redirect",
+    }
+)
+
+# popular domains (including their subdomains) which never redirect to discord invites and are never resolved,
+# unless a path on them is listed as a redirector (e.g. an open redirect endpoint)
+TRUSTED_DOMAINS = frozenset(
+    {
+        "amazon.com",
+        "apple.com",
+        "archlinux.org",
+        "crates.io",
+        "debian.org",
+        "discord.com",
+        "discordapp.com",
+        "discordapp.net",
+        "docs.rs",
+        "giphy.com",
+        "github.com",
+        "gitlab.com",
+        "google.com",
+        "imgur.com",
+        "medium.com",
+        "microsoft.com",
+        "mozilla.org",
+        "npmjs.com",
+        "pypi.org",
+        "python.org",
+        "reddit.com",
+        "stackexchange.com",
+        "stackoverflow.com",
+        "tenor.com",
+        "twitch.tv",
+        "twitter.com",
+        "ubuntu.com",
+        "w3schools.com",
+        "wikipedia.org",
+        "youtu.be",
+        "youtube.com",
+    }
+)
+
+_session: Optional[ClientSession] = None
+
 
 class AllowedServerConverter(Converter):
     async def convert(self, ctx: Context, argument: str) -> AllowedInvite:
@@ -55,13 +153,59 @@ class AllowedServerConverter(Converter):
         raise CommandError(t.allowed_server_not_found)
 
 
-@run_in_thread
-def get_discord_invite(url) -> Optional[str]:
+def get_session() -> ClientSession:
+    """Return the http client session which is shared by all url resolutions."""
+
+    global _session
+
+    if _session is None or _session.closed:
+        _session = ClientSession(
+            timeout=ClientTimeout(total=RESOLVE_DEADLINE), connector=TCPConnector(limit=100, ttl_dns_cache=300)
+        )
+
+    return _session
+
+
+def close_session():
+    """Close the session of the url resolutions when the cog is unloaded."""
+
+    global _session
+
+    if _session is not None and not _session.closed:
+        asyncio.create_task(_session.close())
+    _session = None
+
+
+class ResolvedUrls(NamedTuple):
+    # invite codes the urls point to
+    codes: set[str]
+    # urls whose redirect chain is longer than the maximum number of redirects
+    capped: list[str]
+
+
+class InviteTarget(NamedTuple):
+    guild_id: Optional[int]
+    guild_name: Optional[str]
+    banned: bool = False
+
+
+async def get_discord_invite(url: str, max_redirects: int) -> Optional[str]:
+    """
+    Resolve a url and return the discord invite code it points to.
+
+    :return: the invite code, an empty string if the url does not point to a discord invite, TOO_MANY_REDIRECTS
+             if the url redirects more than max_redirects times or None if the url could not be resolved
+    """
+
     if not re.match(r"^(https?://).*$", url):
         url = "https://" + url
     try:
-        url = requests.head(url, allow_redirects=True, timeout=10).url
-    except (KeyError, AttributeError, requests.RequestException, UnicodeError, ConnectionError, LocationParseError):
+        async with get_session().head(url, allow_redirects=True, max_redirects=max_redirects) as response:
+            url = str(response.url)
+    except TooManyRedirects:
+        logger.info("URL exceeded the maximum number of redirects: %s", url)
+        return TOO_MANY_REDIRECTS
+    except (ClientError, asyncio.TimeoutError, ValueError, UnicodeError):
         logger.info("URL could not be resolved: %s", url)
         return None
 
@@ -70,19 +214,130 @@ def get_discord_invite(url) -> Optional[str]:
     ):
         return match.group("code")
 
+    return ""
+
+
+def parse_direct_invite(url: str) -> Optional[str]:
+    """Return the invite code of a direct discord invite link without any network request."""
+
+    if match := re.match(
+        r"^(https?://)?(www\.)?(discord\.gg|discord(app)?\.com/(\.*/)*invite)/(\.*/)*(?P<code>[a-zA-Z0-9\-]+)",
+        url,
+        re.IGNORECASE,
+    ):
+        return match.group("code")
+
     return None
 
 
-def find_urls(text):
-    return {
-        url
-        for pattern in [
-            r"((https?://)?([a-zA-Z0-9\-_~]+\.)+[a-zA-Z0-9\-_~.]+(\S*[a-zA-Z0-9])?)",
-            r"((https?://)?([a-zA-Z0-9\-_~]+\.)+[a-zA-Z0-9\-_~.]+\S*)",
-            r"((discord\.gg/|discord(app)?\.com/invite/)[a-zA-Z0-9]+)",
-        ]
-        for url, *_ in re.findall(pattern, text)
-    }
+def matches_domain(host: str, path: str, domains: frozenset[str]) -> bool:
+    """Return whether a host (or one of its parent domains), optionally followed by a path prefix, is in a list."""
+
+    segment = path.lstrip("/").split("/", 1)[0]
+    parts = host.split(".")
+    for i in range(len(parts) - 1):
+        domain = ".".join(parts[i:])
+        if domain in domains or f"{domain}/{segment}" in domains:
+            return True
+
+    return False
+
+
+def normalize_domain(domain: str) -> str:
+    """Convert a domain or domain/path prefix given by a user into the format of the redirector list."""
+
+    domain = re.sub(r"^https?://", "", domain.strip().lower()).removeprefix("www.").strip("/")
+    if not re.match(r"^([a-z0-9-]+\.)+[a-z0-9-]+(/[^/\s]+)?$", domain):
+        raise CommandError(t.invalid_domain)
+
+    return domain
+
+
+def needs_resolution(url: str, redirectors: frozenset[str]) -> bool:
+    """Return whether a url might redirect to a discord invite and therefore has to be resolved."""
+
+    try:
+        parts = urlsplit(url if re.match(r"^https?://", url) else "https://" + url)
+        host = (parts.hostname or "").lower().removeprefix("www.")
+    except ValueError:
+        return True
+
+    if matches_domain(host, parts.path, redirectors):
+        return True
+
+    return not matches_domain(host, parts.path, TRUSTED_DOMAINS)
+
+
+async def get_discord_invites(urls: Iterable[str]) -> ResolvedUrls:
+    """
+    Resolve multiple urls concurrently and return the invite codes of those that point to a discord invite
+    together with the urls whose redirect chain is too long to be followed completely.
+    Direct invite links are parsed locally and urls of trusted domains (except for redirector paths) are skipped.
+    All other results (including urls which do not point to an invite) are cached in redis.
+    """
+
+    codes: set[str] = set()
+    capped: list[str] = []
+    candidates: list[str] = []
+    for url in urls:
+        if code := parse_direct_invite(url):
+            codes.add(code)
+        else:
+            candidates.append(url)
+
+    if not candidates:
+        return ResolvedUrls(codes, capped)
+
+    redirectors = REDIRECTOR_DOMAINS | await RedirectorDomain.get_all()
+    ordered = [url for url in candidates if needs_resolution(url, redirectors)]
+    if not ordered:
+        return ResolvedUrls(codes, capped)
+
+    unresolved: list[str] = []
+    for url, cached in zip(ordered, await redis.mget([f"invites:url:{url}" for url in ordered])):
+        if cached is None:
+            unresolved.append(url)
+        elif cached == TOO_MANY_REDIRECTS:
+            capped.append(url)
+        elif cached:
+            codes.add(cached)
+
+    if not unresolved:
+        return ResolvedUrls(codes, capped)
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_RESOLUTIONS)
+    max_redirects: int = await InvitesSettings.max_redirects.get()
+
+    async def resolve(url: str) -> Optional[str]:
+        async with semaphore:
+            return await get_discord_invite(url, max_redirects)
+
+    tasks = {asyncio.create_task(resolve(url)): url for url in unresolved}
+    done, pending = await asyncio.wait(tasks, timeout=RESOLVE_DEADLINE)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logger.info("%d URL(s) could not be resolved within the deadline", len(pending))
+
+    async with redis.pipeline() as pipe:
+        for task in done:
+            code: Optional[str] = task.result()
+            ttl = URL_ERROR_CACHE_TTL if code in (None, TOO_MANY_REDIRECTS) else URL_CACHE_TTL
+            await pipe.setex(f"invites:url:{tasks[task]}", ttl, code or "")
+            if code == TOO_MANY_REDIRECTS:
+                capped.append(tasks[task])
+            elif code:
+                codes.add(code)
+
+        await pipe.execute()
+
+    return ResolvedUrls(codes, capped)
+
+
+def format_invite_log(log: InviteLog) -> str:
+    if log.approved:
+        return t.ulog_invite_approved(f"<@{log.mod}>", log.guild_name)
+    return t.ulog_invite_removed(f"<@{log.mod}>", log.guild_name)
 
 
 class InvitesCog(Cog, name="Allowed Discord Invites"):
@@ -94,21 +349,47 @@ class InvitesCog(Cog, name="Allowed Discord Invites"):
         Contributor.Infinity,
     ]
 
-    @get_userlog_entries.subscribe
-    async def handle_get_ulog_entries(self, user_id: int, _):
-        out = []
+    def cog_unload(self):
+        close_session()
+
+    @get_userlog_sources.subscribe
+    async def handle_get_userlog_sources(self, user_id: int, _) -> list[UserlogSource]:
+        return [
+            query_source(filter_by(InviteLog, applicant=user_id), InviteLog.timestamp, format_invite_log),
+            query_source(
+                filter_by(IllegalInvitePost, member=user_id),
+                IllegalInvitePost.timestamp,
+                lambda post: t.ulog_illegal_post(f"<#{post.channel}>", post.name),
+            ),
+        ]
 
-        async for log in await db.stream(filter_by(InviteLog, applicant=user_id)):  # type: InviteLog
-            if log.approved:
-                out.append((log.timestamp, t.ulog_invite_approved(f"<@{log.mod}>", log.guild_name)))
-            else:
-                out.append((log.timestamp, t.ulog_invite_removed(f"<@{log.mod}>", log.guild_name)))
+    async def get_invite_target(self, code: str) -> InviteTarget:
+        """Return the guild an invite code points to, using a redis cache to avoid fetching the invite."""
+
+        if (cached := await redis.get(key := f"invites:code:{code}")) is not None:
+            if cached == "banned":
+                return InviteTarget(None, None, banned=True)
+            if not cached:
+                return InviteTarget(None, None)
+
+            guild_id, guild_name = cached.split(":", 1)
+            return InviteTarget(int(guild_id), guild_name)
 
-        post: IllegalInvitePost
-        async for post in await db.stream(filter_by(IllegalInvitePost, member=user_id)):
-            out.append((post.timestamp, t.ulog_illegal_post(f"<#{post.channel}>", post.name)))
+        try:
+            invite: Invite = await self.bot.fetch_invite(code)
+        except NotFound:
+            target, cached = InviteTarget(None, None), ""
+        except Forbidden:
+            target, cached = InviteTarget(None, None, banned=True), "banned"
+        else:
+            if invite.guild is None:
+                target, cached = InviteTarget(None, None), ""
+            else:
+                target = InviteTarget(invite.guild.id, invite.guild.name)
+                cached = f"{invite.guild.id}:{invite.guild.name}"
 
-        return out
+        await redis.setex(key, INVITE_CACHE_TTL, cached)
+        return target
 
     async def check_message(self, message: Message) -> bool:
         author: Member = message.author
@@ -117,28 +398,35 @@ class InvitesCog(Cog, name="Allowed Discord Invites"):
         if await InvitesPermission.bypass.check_permissions(author):
             return True
 
+        resolved: ResolvedUrls = await get_discord_invites(get_message_urls(message).candidates)
+        if resolved.capped:
+            # the target of these links is unknown, so they are reported but the message is not deleted
+            await send_alert(
+                message.guild,
+                t.log_too_many_redirects(
+                    f"{author.mention} (`@{author}`, {author.id})",
+                    message.jump_url,
+                    message.channel.mention,
+                    ", ".join(f"<{url}>" for url in resolved.capped),
+                ),
+            )
+
         forbidden = []
         legal_invite = False
-        for url in find_urls(message.content):
-            if (code := await get_discord_invite(url)) is None:
-                continue
-
-            try:
-                invite = await self.bot.fetch_invite(code)
-            except NotFound:
-                continue
-            except Forbidden:
+        for code in resolved.codes:
+            target: InviteTarget = await self.get_invite_target(code)
+            if target.banned:
                 forbidden.append(f"`{code}` (banned from this server)")
                 continue
 
-            if invite.guild is None:
+            if target.guild_id is None:
                 continue
-            if invite.guild == message.guild:
+            if target.guild_id == message.guild.id:
                 legal_invite = True
                 continue
 
-            if await db.get(AllowedInvite, guild_id=invite.guild.id) is None:
-                forbidden.append(f"`{invite.code}` ({invite.guild.name})")
+            if await db.get(AllowedInvite, guild_id=target.guild_id) is None:
+                forbidden.append(f"`{code}` ({target.guild_name})")
             else:
                 legal_invite = True
 
@@ -354,3 +642,80 @@ class InvitesCog(Cog, name="Allowed Discord Invites"):
         embed = Embed(title=t.invites, description=t.server_removed, color=Colors.Invites)
         await reply(ctx, embed=embed)
         await send_to_changelog(ctx.guild, t.log_server_removed(server.guild_name))
+
+    @invites.command(name="redirects", aliases=["rd"])
+    @InvitesPermission.manage.check
+    async def invites_redirects(self, ctx: Context, count: Optional[int] = None):
+        """
+        show or set the maximum number of redirects which are followed to resolve a link
+        """
+
+        if count is None:
+            count = await InvitesSettings.max_redirects.get()
+            embed = Embed(title=t.invites, description=t.max_redirects(count), color=Colors.Invites)
+            await reply(ctx, embed=embed)
+            return
+
+        if not 0 < count <= MAX_REDIRECTS_LIMIT:
+            raise CommandError(t.invalid_max_redirects(MAX_REDIRECTS_LIMIT))
+
+        await InvitesSettings.max_redirects.set(count)
+        embed = Embed(title=t.invites, description=t.max_redirects_set(count), color=Colors.Invites)
+        await reply(ctx, embed=embed)
+        await send_to_changelog(ctx.guild, t.log_max_redirects_set(count))
+
+    @invites.group(name="redirector", aliases=["rdr"])
+    async def redirector(self, ctx: Context):
+        """
+        manage domains which are always resolved to find hidden invites
+        """
+
+        if ctx.invoked_subcommand is None:
+            raise UserInputError
+
+    @redirector.command(name="list", aliases=["l", "?"])
+    async def redirector_list(self, ctx: Context):
+        """
+        list domains which are always resolved
+        """
+
+        embed = Embed(title=t.redirector_domains, colour=Colors.Invites)
+        configured = await RedirectorDomain.get_all()
+        out = [f":small_orange_diamond: `{domain}`" for domain in sorted(REDIRECTOR_DOMAINS)]
+        out += [f":small_blue_diamond: `{domain}`" for domain in sorted(configured - REDIRECTOR_DOMAINS)]
+        embed.description = t.redirector_domains_description + "\n".join(out)
+        await send_long_embed(ctx, embed, paginate=True)
+
+    @redirector.command(name="add", aliases=["a", "+"])
+    @InvitesPermission.manage.check
+    async def redirector_add(self, ctx: Context, domain: str):
+        """
+        always resolve links of a domain (or domain/path prefix)
+        """
+
+        domain = normalize_domain(domain)
+        if domain in REDIRECTOR_DOMAINS or domain in await RedirectorDomain.get_all():
+            raise CommandError(t.redirector_already_added)
+
+        await RedirectorDomain.add(domain)
+        embed = Embed(title=t.invites, description=t.redirector_added(domain), color=Colors.Invites)
+        await reply(ctx, embed=embed)
+        await send_to_changelog(ctx.guild, t.log_redirector_added(domain))
+
+    @redirector.command(name="remove", aliases=["r", "del", "d", "-"])
+    @InvitesPermission.manage.check
+    async def redirector_remove(self, ctx: Context, domain: str):
+        """
+        remove a domain from the list of redirectors
+        """
+
+        domain = normalize_domain(domain)
+        if domain in REDIRECTOR_DOMAINS:
+            raise CommandError(t.redirector_builtin)
+        if domain not in await RedirectorDomain.get_all():
+            raise CommandError(t.redirector_not_found)
+
+        await RedirectorDomain.remove(domain)
+        embed = Embed(title=t.invites, description=t.redirector_removed(domain), color=Colors.Invites)
+        await reply(ctx, embed=embed)
+        await send_to_changelog(ctx.guild, t.log_redirector_removed(domain))
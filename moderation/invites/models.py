@@ -6,7 +6,9 @@ from typing import Optional, Union
 from discord.utils import utcnow
 from sqlalchemy import BigInteger, Boolean, Column, Integer, String, Text
 
-from PyDrocsid.database import Base, UTCDateTime, db
+from PyDrocsid.database import Base, UTCDateTime, db, delete, select
+from PyDrocsid.environment import CACHE_TTL
+from PyDrocsid.redis import redis
 
 
 class AllowedInvite(Base):
@@ -81,3 +83,34 @@ class IllegalInvitePost(Base):
         row = IllegalInvitePost(member=member, member_name=member_name, timestamp=utcnow(), channel=channel, name=name)
         await db.add(row)
         return row
+
+
+class RedirectorDomain(Base):
+    __tablename__ = "invites_redirector_domain"
+
+    domain: Union[Column, str] = Column(String(256), primary_key=True, unique=True)
+
+    @staticmethod
+    async def add(domain: str):
+        await db.add(RedirectorDomain(domain=domain))
+        await RedirectorDomain.load()
+
+    @staticmethod
+    async def remove(domain: str):
+        await db.exec(delete(RedirectorDomain).filter_by(domain=domain))
+        await RedirectorDomain.load()
+
+    @staticmethod
+    async def load() -> frozenset[str]:
+        domains = frozenset([row.domain async for row in await db.stream(select(RedirectorDomain))])
+        await redis.setex("invites:redirectors", CACHE_TTL, " ".join(domains))
+        return domains
+
+    @staticmethod
+    async def get_all() -> frozenset[str]:
+        """Return all configured redirector domains, using a redis cache to avoid a query per message."""
+
+        if (cached := await redis.get("invites:redirectors")) is not None:
+            return frozenset(cached.split())
+
+        return await RedirectorDomain.load()
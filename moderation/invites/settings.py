@@ -0,0 +1,5 @@
+from PyDrocsid.settings import Settings
+
+
+class InvitesSettings(Settings):
+    max_redirects = 20
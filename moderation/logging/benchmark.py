@@ -0,0 +1,71 @@
+"""
+Microbenchmark for the edit distance check of the edit logging.
+
+Compares the bounded edit distance with the full dp for typical edits of messages of different lengths. Run it
+from the directory which contains the cog library package, e.g.::
+
+    python -m cogs.library.moderation.logging.benchmark
+    python -m cogs.library.moderation.logging.benchmark --mindiff 1 5 20 --lengths 100 2000 4000
+"""
+
+import argparse
+import random
+import string
+from time import perf_counter
+from typing import Callable
+
+from PyDrocsid.util import calculate_edit_distance
+
+from .edit_distance import bounded_edit_distance
+
+
+def typo(rng: random.Random, text: str, position: int) -> str:
+    after = position + 1
+    return text[:position] + rng.choice(string.ascii_letters) + text[after:]
+
+
+# edits applied to the original message, each one returns the edited message
+EDITS: dict[str, Callable[[random.Random, str], str]] = {
+    "typo": lambda rng, text: typo(rng, text, len(text) // 2),
+    "append": lambda rng, text: text + " " + "".join(rng.choices(string.ascii_lowercase, k=20)),
+    "scattered": lambda rng, text: "".join(
+        c if rng.random() > 0.01 else rng.choice(string.ascii_letters) for c in text
+    ),
+    "rewrite": lambda rng, text: "".join(rng.choices(string.ascii_lowercase + " ", k=len(text))),
+}
+
+
+def measure(func: Callable[[], object], repeat: int) -> float:
+    """Return the average time (in seconds) of a function call."""
+
+    start = perf_counter()
+    for _ in range(repeat):
+        func()
+    return (perf_counter() - start) / repeat
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mindiff", type=int, nargs="+", default=[1, 5, 20], help="minimum edit distances")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[100, 500, 2000, 4000], help="message lengths")
+    parser.add_argument("--repeat", type=int, default=20, help="number of repetitions per measurement")
+    parser.add_argument("--full-limit", type=int, default=500, help="maximum length for the full dp (it is slow)")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    print(f"{'length':>6} {'edit':>9} {'mindiff':>7} {'bounded':>12} {'full':>12}")
+    for length in args.lengths:
+        text = "".join(rng.choices(string.ascii_lowercase + " ", k=length))
+        for name, edit in EDITS.items():
+            edited = edit(rng, text)
+            full = "-"
+            if length <= args.full_limit:
+                full = f"{measure(lambda: calculate_edit_distance(text, edited), 1) * 1000:.3f} ms"
+
+            for mindiff in args.mindiff:
+                seconds = measure(lambda: bounded_edit_distance(text, edited, mindiff), args.repeat)  # noqa: B023
+                print(f"{length:>6} {name:>9} {mindiff:>7} {seconds * 1000:>9.3f} ms {full:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,45 @@
+import asyncio
 import json
-from datetime import timedelta
+from datetime import datetime, timedelta
 from io import StringIO
 from typing import Optional, Union
 
-from discord import Embed, File, Forbidden, Guild, Member, Message, RawMessageDeleteEvent, TextChannel
+from discord import (
+    ClientException,
+    Embed,
+    File,
+    Guild,
+    HTTPException,
+    Member,
+    Message,
+    NotFound,
+    Object,
+    RawBulkMessageDeleteEvent,
+    RawMessageDeleteEvent,
+    TextChannel,
+)
 from discord.ext import commands, tasks
 from discord.ext.commands import Command, CommandError, Context, Group, UserInputError, guild_only
 from discord.utils import format_dt, snowflake_time, utcnow
 
 from PyDrocsid.cog import Cog
 from PyDrocsid.command import docs, reply
-from PyDrocsid.database import db_wrapper
+from PyDrocsid.database import db_context, db_wrapper
 from PyDrocsid.embeds import send_long_embed
 from PyDrocsid.environment import CACHE_TTL
 from PyDrocsid.logger import get_logger
 from PyDrocsid.redis import redis
 from PyDrocsid.translations import t
-from PyDrocsid.util import calculate_edit_distance, check_message_send_permissions
+from PyDrocsid.util import check_message_send_permissions
 
 from .colors import Colors
+from .delivery import log_delivery
+from .edit_distance import edit_distance_below
+from .message_store import StoredMessage, message_store
 from .models import LogExclude
 from .permissions import LoggingPermission
 from .settings import LoggingSettings
+from .snapshot import MESSAGE_LOG_CHANNELS, logging_snapshot
 from ...contributor import Contributor
 from ...pubsub import can_respond_on_reaction, ignore_message_delete, ignore_message_edit, send_alert, send_to_changelog
 
@@ -31,6 +49,16 @@ logger = get_logger(__name__)
 tg = t.g
 t = t.logging
 
+# maximum number of authors which are mentioned in the log entry of a bulk delete
+MAX_BULK_DELETE_AUTHORS = 20
+
+# messages younger than this can be deleted using the bulk delete endpoint (which accepts up to 100 messages)
+BULK_DELETE_MAX_AGE = timedelta(days=14, minutes=-10)
+BULK_DELETE_SIZE = 100
+
+# time (in seconds) between two deletions of messages which are too old for the bulk delete endpoint
+SINGLE_DELETE_INTERVAL = 2
+
 
 def add_field(embed: Embed, name: str, text: str):
     first = True
@@ -42,7 +70,7 @@ def add_field(embed: Embed, name: str, text: str):
 
 async def send_to_channel(guild: Guild, setting: LoggingSettings, message: Union[str, Embed]):
     msg = json.dumps(message.to_dict()) if isinstance(message, Embed) else message
-    channel: Optional[TextChannel] = guild.get_channel(await setting.get())
+    channel: Optional[TextChannel] = guild.get_channel(await logging_snapshot.get_channel_id(setting))
     if not channel:
         logger.warning(f"Could not send message to {setting.name}: {msg}")
         return
@@ -52,24 +80,99 @@ async def send_to_channel(guild: Guild, setting: LoggingSettings, message: Union
     else:
         embed = message
 
-    try:
-        await channel.send(embed=embed)
-    except Forbidden:
-        logger.warning(f"Could not send message to {setting.name}: {msg}")
-    else:
-        logger.info(f"{setting.name}: {msg}")
+    log_delivery.send(channel, embed=embed)
+    logger.info(f"{setting.name}: {msg}")
 
 
-async def is_logging_channel(channel: TextChannel) -> bool:
-    for setting in [LoggingSettings.edit_channel, LoggingSettings.delete_channel]:
-        if channel.id == await setting.get():
-            return True
+def _dump_embeds(embeds: list[Embed], file_name: str) -> File:
+    return File(filename=file_name, fp=StringIO(json.dumps([embed.to_dict() for embed in embeds], indent=4)))
 
-    return False
 
+def _dump_message(message: Message) -> dict:
+    return {
+        "id": message.id,
+        "cached": True,
+        "author": str(message.author),
+        "author_id": message.author.id,
+        "created_at": message.created_at.isoformat(),
+        "content": message.content,
+        "attachments": [
+            {"filename": attachment.filename, "url": attachment.url, "size": attachment.size}
+            for attachment in message.attachments
+        ],
+        "embeds": [embed.to_dict() for embed in message.embeds],
+    }
+
+
+async def cleanup_channel(channel: TextChannel, timestamp: datetime):
+    """
+    Delete all messages of a log channel which have been sent before the given timestamp.
+
+    Messages younger than 14 days are deleted in batches using the bulk delete endpoint, older messages are deleted
+    one at a time at a slow pace. The id of the last deleted message is stored in redis, so subsequent runs only
+    have to look at messages which have been sent since then.
+    """
+
+    key = f"logging:cleanup_cursor:{channel.id}"
+    after = Object(int(cursor)) if (cursor := await redis.get(key)) else None
+    bulk_limit = utcnow() - BULK_DELETE_MAX_AGE
+
+    batch: list[Message] = []
+
+    async def delete_batch() -> bool:
+        try:
+            await channel.delete_messages(batch)
+        except (HTTPException, ClientException) as e:
+            logger.warning(f"Could not delete {len(batch)} messages in log channel {channel.id}: {e}")
+            return False
+
+        await redis.set(key, batch[-1].id)
+        batch.clear()
+        return True
+
+    async for message in channel.history(limit=None, after=after, before=timestamp, oldest_first=True):
+        if message.created_at >= bulk_limit:
+            batch.append(message)
+            if len(batch) >= BULK_DELETE_SIZE and not await delete_batch():
+                return
+            continue
+
+        try:
+            await message.delete()
+        except NotFound:
+            pass
+        except HTTPException as e:
+            logger.warning(f"Could not delete message {message.id} in log channel {channel.id}: {e}")
+            return
+
+        await redis.set(key, message.id)
+        await asyncio.sleep(SINGLE_DELETE_INTERVAL)
+
+    if batch:
+        await delete_batch()
+
+
+def _dump_stored_message(message_id: int, message: StoredMessage) -> dict:
+    return {
+        "id": message_id,
+        "cached": False,
+        "author": message.author_name,
+        "author_id": message.author_id,
+        "created_at": snowflake_time(message_id).isoformat(),
+        "content": message.content,
+        "attachments": [{"url": url} for url in message.attachments],
+    }
 
-def _dump_embeds(embeds: list[Embed], file_name: str) -> File:
-    return File(filename=file_name, fp=StringIO(json.dumps([embed.to_dict() for embed in embeds], indent=4)))
+
+async def store_message(message: Message):
+    if not message_store.budget:
+        return
+    if await logging_snapshot.is_excluded(message.channel.id):
+        return
+    if await logging_snapshot.is_log_channel(message.channel.id):
+        return
+
+    message_store.add(message)
 
 
 channels: list[str] = []
@@ -91,6 +194,7 @@ def add_channel(group: Group, name: str, *aliases: str) -> tuple[Group, Command,
         check_message_send_permissions(channel, check_embed=True)
 
         await getattr(LoggingSettings, f"{name}_channel").set(channel.id)
+        logging_snapshot.invalidate()
         embed = Embed(
             title=t.logging,
             description=(text := getattr(t.channels, name).updated(channel.mention)),
@@ -103,6 +207,7 @@ def add_channel(group: Group, name: str, *aliases: str) -> tuple[Group, Command,
     @docs(getattr(t.channels, name).disable_description)
     async def disable_channel(ctx: Context):
         await getattr(LoggingSettings, f"{name}_channel").reset()
+        logging_snapshot.invalidate()
         embed = Embed(title=t.logging, description=(text := getattr(t.channels, name).disabled), color=Colors.Logging)
         await reply(ctx, embed=embed)
         await send_to_changelog(ctx.guild, text)
@@ -114,7 +219,7 @@ class LoggingCog(Cog, name="Logging"):
     CONTRIBUTORS = [Contributor.Defelo, Contributor.wolflu, Contributor.Tert0, Contributor.Infinity]
 
     async def get_logging_channel(self, setting: LoggingSettings) -> Optional[TextChannel]:
-        return self.bot.get_channel(await setting.get())
+        return self.bot.get_channel(await logging_snapshot.get_channel_id(setting))
 
     @send_to_changelog.subscribe
     async def handle_send_to_changelog(self, guild: Guild, message: Union[str, Embed]):
@@ -126,17 +231,7 @@ class LoggingCog(Cog, name="Logging"):
 
     @can_respond_on_reaction.subscribe
     async def handle_can_respond_on_reaction(self, channel: TextChannel) -> bool:
-        for setting in [
-            LoggingSettings.edit_channel,
-            LoggingSettings.delete_channel,
-            LoggingSettings.alert_channel,
-            LoggingSettings.changelog_channel,
-            LoggingSettings.member_join_channel,
-            LoggingSettings.member_leave_channel,
-        ]:
-            if await setting.get() == channel.id:
-                return False
-        return True
+        return not await logging_snapshot.is_log_channel(channel.id)
 
     @ignore_message_edit.subscribe
     async def handle_ignore_message_edit(self, message: Message):
@@ -147,44 +242,49 @@ class LoggingCog(Cog, name="Logging"):
         await redis.setex(f"ignore_message_delete:{message.channel.id}:{message.id}", CACHE_TTL, 1)
 
     async def on_ready(self):
+        message_store.resize(await LoggingSettings.message_store_budget.get() * 1024)
+
         try:
             self.cleanup_loop.start()
         except RuntimeError:
             self.cleanup_loop.restart()
 
     @tasks.loop(minutes=30)
-    @db_wrapper
     async def cleanup_loop(self):
-        days: int = await LoggingSettings.maxage.get()
-        if days == -1:
-            return
+        # the database session is only needed to read the settings, not for the whole (possibly long) cleanup
+        async with db_context():
+            days: int = await LoggingSettings.maxage.get()
+            if days == -1:
+                return
+
+            log_channels = [await self.get_logging_channel(setting) for setting in MESSAGE_LOG_CHANNELS]
 
         timestamp = utcnow() - timedelta(days=days)
-        for setting in [LoggingSettings.edit_channel, LoggingSettings.delete_channel]:
-            channel: Optional[TextChannel] = await self.get_logging_channel(setting)
-            if channel is None:
-                continue
+        for channel in log_channels:
+            if channel is not None:
+                await cleanup_channel(channel, timestamp)
 
-            async for message in channel.history(limit=None, oldest_first=True):  # type: Message
-                if message.created_at > timestamp:
-                    break
+    async def on_message(self, message: Message):
+        if message.guild is None:
+            return
 
-                await message.delete()
+        await store_message(message)
 
     async def on_message_edit(self, before: Message, after: Message):
         if before.guild is None:
             return
+        await store_message(after)
         if await redis.delete(f"ignore_message_edit:{before.channel.id}:{before.id}"):
             return
         mindiff: int = await LoggingSettings.edit_mindiff.get()
         old_message = await redis.get(key := f"little_diff_message_edit:{before.id}") or before.content
-        if calculate_edit_distance(old_message, after.content) < mindiff and before.embeds == after.embeds:
+        if before.embeds == after.embeds and await edit_distance_below(old_message, after.content, mindiff):
             if not await redis.exists(key):
                 await redis.setex(key, 60 * 60 * 24, before.content)
             return
         if (edit_channel := await self.get_logging_channel(LoggingSettings.edit_channel)) is None:
             return
-        if await LogExclude.exists(after.channel.id):
+        if await logging_snapshot.is_excluded(after.channel.id):
             return
         await redis.delete(key)
         embed = Embed(title=t.message_edited, color=Colors.edit)
@@ -206,16 +306,18 @@ class LoggingCog(Cog, name="Logging"):
         if after.embeds:
             files.append(_dump_embeds(after.embeds, t.after_edited_embeds))
 
-        await edit_channel.send(embed=embed, files=files)
+        log_delivery.send(edit_channel, embed=embed, files=files)
 
     async def on_raw_message_edit(self, channel: TextChannel, message: Message):
         if message.guild is None:
             return
+        stored = message_store.get(message.id)
+        await store_message(message)
         if await redis.delete(f"ignore_message_edit:{channel.id}:{message.id}"):
             return
         if (edit_channel := await self.get_logging_channel(LoggingSettings.edit_channel)) is None:
             return
-        if await LogExclude.exists(message.channel.id):
+        if await logging_snapshot.is_excluded(message.channel.id):
             return
 
         embed = Embed(title=t.message_edited, color=Colors.edit)
@@ -230,23 +332,26 @@ class LoggingCog(Cog, name="Logging"):
                 value=f"{format_dt(message.created_at, style='D')} {format_dt(message.created_at, style='T')}",
             )
             embed.add_field(name=t.url, value=message.jump_url, inline=False)
+            if stored is not None:
+                add_field(embed, t.old_content, stored.content)
             add_field(embed, t.new_content, message.content)
         file = None
         if message.embeds:
             file = _dump_embeds(message.embeds, t.after_edited_embeds)
-        await edit_channel.send(embed=embed, file=file)
+        log_delivery.send(edit_channel, embed=embed, files=[file])
 
     async def on_message_delete(self, message: Message):
         if message.guild is None:
             return
+        message_store.pop(message.id)
         if await redis.delete(f"ignore_message_delete:{message.channel.id}:{message.id}"):
             return
         if (delete_channel := await self.get_logging_channel(LoggingSettings.delete_channel)) is None:
             return
         await redis.delete(f"little_diff_message_edit:{message.id}")
-        if await is_logging_channel(message.channel):
+        if await logging_snapshot.is_message_log_channel(message.channel.id):
             return
-        if await LogExclude.exists(message.channel.id):
+        if await logging_snapshot.is_excluded(message.channel.id):
             return
 
         embed = Embed(title=t.message_deleted, color=Colors.delete)
@@ -273,44 +378,109 @@ class LoggingCog(Cog, name="Logging"):
         files = None
         if message.embeds:
             files = _dump_embeds(message.embeds, t.after_deleted_embeds)
-        await delete_channel.send(embed=embed, file=files)
+        log_delivery.send(delete_channel, embed=embed, files=[files])
 
     async def on_raw_message_delete(self, event: RawMessageDeleteEvent):
         if event.guild_id is None:
             return
+        stored = message_store.pop(event.message_id)
         if await redis.delete(f"ignore_message_delete:{event.channel_id}:{event.message_id}"):
             return
         if (delete_channel := await self.get_logging_channel(LoggingSettings.delete_channel)) is None:
             return
         await redis.delete(f"little_diff_message_edit:{event.message_id}")
-        if await LogExclude.exists(event.channel_id):
+        if await logging_snapshot.is_excluded(event.channel_id):
             return
 
         embed = Embed(title=t.message_deleted, color=Colors.delete)
         channel: Optional[TextChannel] = self.bot.get_channel(event.channel_id)
         if channel is not None:
-            if await is_logging_channel(channel):
+            if await logging_snapshot.is_message_log_channel(channel.id):
                 return
 
             embed.add_field(name=t.channel, value=channel.mention)
-            embed.add_field(name=t.message_id, value=event.message_id, inline=False)
+            if stored is not None:
+                embed.set_author(name=stored.author_name)
+                embed.add_field(name=t.author, value=f"<@{stored.author_id}>")
+                embed.add_field(name=t.author_id, value=stored.author_id)
+            embed.add_field(name=t.message_id, value=event.message_id, inline=stored is not None)
             created_at = snowflake_time(event.message_id)
             embed.add_field(
                 name=t.created_at, value=f"{format_dt(created_at, style='D')} {format_dt(created_at, style='T')}"
             )
-        await delete_channel.send(embed=embed)
+            if stored is not None:
+                add_field(embed, t.old_content, stored.content)
+                if stored.attachments:
+                    embed.add_field(name=t.attachments, value="\n".join(stored.attachments), inline=False)
+        log_delivery.send(delete_channel, embed=embed)
+
+    @commands.Cog.listener()
+    @db_wrapper
+    async def on_raw_bulk_message_delete(self, event: RawBulkMessageDeleteEvent):
+        if event.guild_id is None:
+            return
+
+        message_ids = sorted(event.message_ids)
+        stored = {message_id: message for message_id in message_ids if (message := message_store.pop(message_id))}
+        async with redis.pipeline() as pipe:
+            for message_id in message_ids:
+                await pipe.delete(f"ignore_message_delete:{event.channel_id}:{message_id}")
+            await pipe.delete(*[f"little_diff_message_edit:{message_id}" for message_id in message_ids])
+            *ignored, _ = await pipe.execute()
+
+        if not (message_ids := [message_id for message_id, ign in zip(message_ids, ignored) if not ign]):
+            return
+        if (delete_channel := await self.get_logging_channel(LoggingSettings.delete_channel)) is None:
+            return
+        if await logging_snapshot.is_excluded(event.channel_id):
+            return
+
+        channel: Optional[TextChannel] = self.bot.get_channel(event.channel_id)
+        if channel is not None and await logging_snapshot.is_message_log_channel(channel.id):
+            return
+
+        cached = {message.id: message for message in event.cached_messages}
+        embed = Embed(title=t.messages_bulk_deleted, color=Colors.delete)
+        embed.add_field(name=t.channel, value=channel.mention if channel else f"<#{event.channel_id}>")
+        embed.add_field(name=t.message_count, value=str(len(message_ids)))
+        embed.add_field(
+            name=t.uncached_count,
+            value=str(sum(message_id not in cached and message_id not in stored for message_id in message_ids)),
+        )
+        authors = list(
+            {
+                **{message.author_id: f"<@{message.author_id}>" for message in stored.values()},
+                **{message.author.id: message.author.mention for message in cached.values()},
+            }.values()
+        )
+        if authors:
+            out = ", ".join(authors[:MAX_BULK_DELETE_AUTHORS])
+            if len(authors) > MAX_BULK_DELETE_AUTHORS:
+                out += ", ..."
+            embed.add_field(name=t.authors, value=out, inline=False)
+
+        transcript = []
+        for message_id in message_ids:
+            if message_id in cached:
+                transcript.append(_dump_message(cached[message_id]))
+            elif message_id in stored:
+                transcript.append(_dump_stored_message(message_id, stored[message_id]))
+            else:
+                transcript.append({"id": message_id, "cached": False})
+        file = File(filename=t.bulk_deleted_transcript, fp=StringIO(json.dumps(transcript, indent=4)))
+        log_delivery.send(delete_channel, embed=embed, files=[file])
 
     async def on_member_join(self, member: Member):
         if (log_channel := await self.get_logging_channel(LoggingSettings.member_join_channel)) is None:
             return
 
-        await log_channel.send(t.member_joined_server(member.mention, member))
+        log_delivery.send(log_channel, t.member_joined_server(member.mention, member))
 
     async def on_member_remove(self, member: Member):
         if (log_channel := await self.get_logging_channel(LoggingSettings.member_leave_channel)) is None:
             return
 
-        await log_channel.send(t.member_left_server(member))
+        log_delivery.send(log_channel, t.member_left_server(member))
 
     @commands.group(aliases=["log"])
     @LoggingPermission.read.check
@@ -342,6 +512,24 @@ class LoggingCog(Cog, name="Logging"):
                 mindist: int = await LoggingSettings.edit_mindiff.get()
                 embed.add_field(name=t.channels.edit.mindist.name, value=str(mindist), inline=True)
 
+        if budget := message_store.budget:
+            embed.add_field(
+                name=t.message_store,
+                value=t.message_store_usage(message_store.size // 1024, budget // 1024, cnt=len(message_store.entries)),
+                inline=False,
+            )
+        else:
+            embed.add_field(name=t.message_store, value=tg.disabled, inline=False)
+
+        if status := log_delivery.status():
+            embed.add_field(
+                name=t.delivery_queue,
+                value="\n".join(
+                    t.delivery_queue_status(channel.mention, round(lag), cnt=depth) for channel, depth, lag in status
+                ),
+                inline=False,
+            )
+
         await reply(ctx, embed=embed)
 
     @logging.command(name="maxage", aliases=["ma"])
@@ -362,6 +550,22 @@ class LoggingCog(Cog, name="Logging"):
 
         await reply(ctx, embed=embed)
 
+    @logging.command(name="store", aliases=["s"])
+    @LoggingPermission.write.check
+    @docs(t.commands.message_store)
+    async def logging_store(self, ctx: Context, kilobytes: int):
+        if not 0 <= kilobytes < (1 << 31):
+            raise CommandError(t.invalid_message_store_budget)
+
+        await LoggingSettings.message_store_budget.set(kilobytes)
+        message_store.resize(kilobytes * 1024)
+        if kilobytes:
+            text = t.message_store_set(kilobytes)
+        else:
+            text = t.message_store_set_disabled
+        await reply(ctx, embed=Embed(title=t.logging, description=text, color=Colors.Logging))
+        await send_to_changelog(ctx.guild, text)
+
     logging_edit, *_ = add_channel(logging, "edit", "e")
     logging_delete, *_ = add_channel(logging, "delete", "d")
     logging_alert, *_ = add_channel(logging, "alert", "al", "a")
@@ -394,6 +598,7 @@ class LoggingCog(Cog, name="Logging"):
             channel: Optional[TextChannel] = self.bot.get_channel(channel_id)
             if channel is None:
                 await LogExclude.remove(channel_id)
+                logging_snapshot.invalidate()
             else:
                 out.append(f":small_blue_diamond: {channel.mention}")
         if not out:
@@ -411,6 +616,7 @@ class LoggingCog(Cog, name="Logging"):
             raise CommandError(t.already_excluded)
 
         await LogExclude.add(channel.id)
+        logging_snapshot.invalidate()
         embed = Embed(title=t.excluded_channels, description=t.excluded, colour=Colors.Logging)
         await reply(ctx, embed=embed)
         await send_to_changelog(ctx.guild, t.log_excluded(channel.mention))
@@ -423,6 +629,7 @@ class LoggingCog(Cog, name="Logging"):
             raise CommandError(t.not_excluded)
 
         await LogExclude.remove(channel.id)
+        logging_snapshot.invalidate()
         embed = Embed(title=t.excluded_channels, description=t.unexcluded, colour=Colors.Logging)
         await reply(ctx, embed=embed)
         await send_to_changelog(ctx.guild, t.log_unexcluded(channel.mention))
@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+from time import monotonic
+from typing import Iterable, NamedTuple, Optional
+
+from discord import Embed, File, Forbidden, HTTPException, TextChannel
+
+from PyDrocsid.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+# time (in seconds) for which log entries are collected before they are sent, unless a message is already full
+FLUSH_INTERVAL = 2
+
+# limits of a single discord message
+MAX_EMBEDS = 10
+MAX_FILES = 10
+MAX_EMBED_CHARACTERS = 6000
+MAX_CONTENT_LENGTH = 2000
+
+# maximum number of pending log entries per channel, older entries are dropped if this limit is exceeded
+MAX_QUEUE_SIZE = 5000
+
+
+class LogEntry(NamedTuple):
+    content: Optional[str]
+    embed: Optional[Embed]
+    files: list[File]
+    queued_at: float
+
+
+class ChannelQueue:
+    """
+    Delivery queue of a single log channel.
+
+    Consecutive embeds are packed into as few messages as possible (up to 10 embeds per message) and consecutive
+    text entries are joined into a single message. Messages are sent one after another, so a burst of log entries
+    never causes more than one pending request per channel.
+    """
+
+    def __init__(self, channel: TextChannel):
+        self.channel: TextChannel = channel
+        self.entries: deque[LogEntry] = deque()
+        self.full = asyncio.Event()
+        self.task: Optional[asyncio.Task[None]] = None
+        self.dropped: int = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self.entries)
+
+    @property
+    def lag(self) -> float:
+        """Return the time (in seconds) the oldest pending log entry has been waiting."""
+
+        return monotonic() - self.entries[0].queued_at if self.entries else 0
+
+    def add(self, entry: LogEntry):
+        if len(self.entries) >= MAX_QUEUE_SIZE:
+            self.entries.popleft()
+            self.dropped += 1
+            logger.warning(f"Log queue of channel {self.channel.id} is full, dropped {self.dropped} entries so far")
+
+        self.entries.append(entry)
+        if len(self.entries) >= MAX_EMBEDS:
+            self.full.set()
+
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def take_batch(self) -> list[LogEntry]:
+        """Remove and return the log entries which can be sent in a single message."""
+
+        batch: list[LogEntry] = [self.entries.popleft()]
+        if batch[0].embed is None:
+            length = len(batch[0].content or "")
+            while self.entries and self.entries[0].embed is None:
+                length += len(self.entries[0].content or "") + 1
+                if length > MAX_CONTENT_LENGTH:
+                    break
+                batch.append(self.entries.popleft())
+        else:
+            characters, files = len(batch[0].embed), len(batch[0].files)
+            while self.entries and (entry := self.entries[0]).embed is not None and len(batch) < MAX_EMBEDS:
+                characters += len(entry.embed)
+                files += len(entry.files)
+                if characters > MAX_EMBED_CHARACTERS or files > MAX_FILES:
+                    break
+                batch.append(self.entries.popleft())
+
+        if len(self.entries) < MAX_EMBEDS:
+            self.full.clear()
+
+        return batch
+
+    async def run(self):
+        try:
+            while self.entries:
+                if not self.full.is_set():
+                    try:
+                        await asyncio.wait_for(self.full.wait(), FLUSH_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+
+                await self.send(self.take_batch())
+        finally:
+            self.task = None
+
+    async def send(self, batch: list[LogEntry]):
+        content = "\n".join(entry.content for entry in batch if entry.content) or None
+        embeds = [entry.embed for entry in batch if entry.embed is not None]
+        files = [file for entry in batch for file in entry.files]
+
+        while True:
+            try:
+                await self.channel.send(content=content, embeds=embeds or None, files=files or None)
+            except Forbidden:
+                logger.warning(f"Could not send {len(batch)} log entries to channel {self.channel.id}")
+            except HTTPException as e:
+                if e.status != 429:
+                    logger.exception(f"Could not send {len(batch)} log entries to channel {self.channel.id}")
+                    return
+
+                # the library has given up retrying, so wait as long as discord asks us to and try again
+                retry_after = float(e.response.headers.get("Retry-After", FLUSH_INTERVAL))
+                logger.warning(f"Log channel {self.channel.id} is rate limited, retrying in {retry_after} seconds")
+                await asyncio.sleep(retry_after)
+                for file in files:
+                    file.reset()
+                continue
+
+            return
+
+
+class LogDelivery:
+    """Batched delivery of log entries with one queue per log channel."""
+
+    def __init__(self):
+        self.queues: dict[int, ChannelQueue] = {}
+
+    def send(
+        self,
+        channel: TextChannel,
+        content: Optional[str] = None,
+        *,
+        embed: Optional[Embed] = None,
+        files: Iterable[Optional[File]] = (),
+    ):
+        if (queue := self.queues.get(channel.id)) is None:
+            queue = self.queues[channel.id] = ChannelQueue(channel)
+
+        queue.channel = channel
+        queue.add(LogEntry(content, embed, [file for file in files if file is not None], monotonic()))
+
+    def status(self) -> list[tuple[TextChannel, int, float]]:
+        """Return the depth and the lag (in seconds) of all non-empty queues."""
+
+        return [(queue.channel, queue.depth, queue.lag) for queue in self.queues.values() if queue.depth]
+
+
+log_delivery = LogDelivery()
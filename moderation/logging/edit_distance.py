@@ -0,0 +1,72 @@
+from PyDrocsid.async_thread import run_in_thread
+
+
+# number of dp cells above which the edit distance is calculated in a separate thread
+THREAD_THRESHOLD = 100_000
+
+
+def _strip_common_affixes(a: str, b: str) -> tuple[str, str]:
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+
+    end = 0
+    while end < len(a) - start and end < len(b) - start and a[-end - 1] == b[-end - 1]:
+        end += 1
+
+    a_end, b_end = len(a) - end, len(b) - end
+    return a[start:a_end], b[start:b_end]
+
+
+def bounded_edit_distance(a: str, b: str, limit: int) -> int:
+    """
+    Calculate the edit distance (Levenshtein distance) between two strings, but give up once it reaches a limit.
+
+    Only the cells of the dp table which are at most limit - 1 cells away from the diagonal are calculated and the
+    calculation stops as soon as a whole row exceeds the limit.
+
+    :return: the edit distance if it is less than the limit, otherwise the limit
+    """
+
+    a, b = _strip_common_affixes(a, b)
+    if len(a) > len(b):
+        a, b = b, a
+
+    n, m = len(a), len(b)
+    if m - n >= limit:
+        return limit
+    if not n:
+        return m
+
+    # max distance of interest, all larger values are capped at the limit
+    k = limit - 1
+    prev = [min(j, limit) for j in range(m + 1)]
+    cur = [limit] * (m + 1)
+    for i in range(1, n + 1):
+        lo, hi = max(1, i - k), min(m, i + k)
+        cur[lo - 1] = min(i, limit) if lo == 1 else limit
+        if hi < m:
+            cur[hi + 1] = limit
+
+        row_min = cur[lo - 1]
+        for j in range(lo, hi + 1):
+            value = min(prev[j - 1] + (a[i - 1] != b[j - 1]), prev[j] + 1, cur[j - 1] + 1, limit)
+            cur[j] = value
+            row_min = min(row_min, value)
+
+        if row_min >= limit:
+            return limit
+
+        prev, cur = cur, prev
+
+    return prev[m]
+
+
+async def edit_distance_below(a: str, b: str, limit: int) -> bool:
+    """Return whether the edit distance between two strings is less than the limit."""
+
+    a, b = _strip_common_affixes(a, b)
+    if min(len(a), len(b)) * (2 * limit + 1) > THREAD_THRESHOLD:
+        return await run_in_thread(bounded_edit_distance)(a, b, limit) < limit
+
+    return bounded_edit_distance(a, b, limit) < limit
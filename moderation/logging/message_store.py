@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from time import monotonic
+from typing import NamedTuple, Optional
+
+from discord import Message
+
+
+# time (in seconds) after which stored messages are evicted
+MESSAGE_STORE_TTL = 7 * 24 * 60 * 60
+
+# estimated memory usage (in bytes) of a stored message in addition to its content and attachments
+ENTRY_OVERHEAD = 200
+
+
+class StoredMessage(NamedTuple):
+    channel_id: int
+    author_id: int
+    author_name: str
+    content: str
+    attachments: list[str]
+
+
+class _Entry(NamedTuple):
+    stored_at: float
+    channel_id: int
+    author_id: int
+    content: bytes
+    attachments: bytes
+
+    @property
+    def size(self) -> int:
+        return len(self.content) + len(self.attachments) + ENTRY_OVERHEAD
+
+
+class MessageStore:
+    """
+    Memory-bounded store of the content of recent messages.
+
+    The library only keeps a limited number of messages in its cache, so raw edit and delete events usually lack the
+    old content and the author of a message. This store keeps the content in a compact form (utf-8 encoded content,
+    author names interned by author id) within a configurable byte budget and evicts the least recently stored
+    messages once the budget is exceeded or the messages are older than the ttl.
+    """
+
+    def __init__(self):
+        self.entries: OrderedDict[int, _Entry] = OrderedDict()
+        # author id -> [author name, number of stored messages of this author]
+        self.authors: dict[int, list] = {}
+        self.budget: int = 0
+        self.size: int = 0
+
+    def resize(self, budget: int):
+        self.budget = budget
+        self._evict()
+
+    def add(self, message: Message):
+        if not self.budget:
+            return
+
+        self._remove(message.id)
+        entry = _Entry(
+            monotonic(),
+            message.channel.id,
+            message.author.id,
+            message.content.encode(),
+            "\n".join(attachment.url for attachment in message.attachments).encode(),
+        )
+        self.entries[message.id] = entry
+        self.size += entry.size
+
+        author = self.authors.setdefault(message.author.id, [str(message.author), 0])
+        author[0] = str(message.author)
+        author[1] += 1
+
+        self._evict()
+
+    def get(self, message_id: int) -> Optional[StoredMessage]:
+        if (entry := self.entries.get(message_id)) is None or monotonic() - entry.stored_at > MESSAGE_STORE_TTL:
+            return None
+
+        return StoredMessage(
+            entry.channel_id,
+            entry.author_id,
+            self.authors[entry.author_id][0],
+            entry.content.decode(),
+            entry.attachments.decode().split("\n") if entry.attachments else [],
+        )
+
+    def pop(self, message_id: int) -> Optional[StoredMessage]:
+        message = self.get(message_id)
+        self._remove(message_id)
+        return message
+
+    def _remove(self, message_id: int):
+        if (entry := self.entries.pop(message_id, None)) is None:
+            return
+
+        self.size -= entry.size
+        author = self.authors[entry.author_id]
+        author[1] -= 1
+        if not author[1]:
+            self.authors.pop(entry.author_id)
+
+    def _evict(self):
+        now = monotonic()
+        while self.entries:
+            message_id, entry = next(iter(self.entries.items()))
+            if self.size <= self.budget and now - entry.stored_at <= MESSAGE_STORE_TTL:
+                break
+
+            self._remove(message_id)
+
+
+message_store = MessageStore()
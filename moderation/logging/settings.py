@@ -4,6 +4,7 @@ from PyDrocsid.settings import Settings
 class LoggingSettings(Settings):
     maxage = -1
     edit_mindiff = 1
+    message_store_budget = 0
 
     edit_channel = -1
     delete_channel = -1
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import asyncio
+from time import monotonic
+from typing import Optional
+
+from .models import LogExclude
+from .settings import LoggingSettings
+
+
+# time (in seconds) after which the snapshot is reloaded even if it has not been invalidated
+SNAPSHOT_TTL = 5 * 60
+
+# log channels of message events, which must not be logged themselves
+MESSAGE_LOG_CHANNELS = [LoggingSettings.edit_channel, LoggingSettings.delete_channel]
+
+
+class LoggingSnapshot:
+    """
+    In-memory snapshot of the excluded channels and all logging channel ids.
+
+    Event handlers only need to look up channel ids in plain sets instead of querying the database and reading
+    multiple settings for every event. The snapshot has to be invalidated whenever one of these values is changed.
+    """
+
+    def __init__(self):
+        self.excluded: set[int] = set()
+        self.channels: dict[LoggingSettings, int] = {}
+        self.message_log_channels: set[int] = set()
+        self.all_channels: set[int] = set()
+        self.loaded_at: Optional[float] = None
+        self.generation: int = 0
+        self.lock = asyncio.Lock()
+
+    def invalidate(self):
+        self.loaded_at = None
+        self.generation += 1
+
+    async def load(self) -> LoggingSnapshot:
+        if self.loaded_at is not None and monotonic() - self.loaded_at < SNAPSHOT_TTL:
+            return self
+
+        async with self.lock:
+            if self.loaded_at is not None and monotonic() - self.loaded_at < SNAPSHOT_TTL:
+                return self
+
+            loaded_at, generation = monotonic(), self.generation
+            self.excluded = set(await LogExclude.all())
+            self.channels = {
+                setting: await setting.get() for setting in LoggingSettings if setting.name.endswith("_channel")
+            }
+            self.message_log_channels = {self.channels[setting] for setting in MESSAGE_LOG_CHANNELS}
+            self.all_channels = set(self.channels.values())
+            if generation == self.generation:
+                # do not mark the snapshot as fresh if it has been invalidated while loading
+                self.loaded_at = loaded_at
+
+        return self
+
+    async def get_channel_id(self, setting: LoggingSettings) -> int:
+        return (await self.load()).channels[setting]
+
+    async def is_excluded(self, channel_id: int) -> bool:
+        return channel_id in (await self.load()).excluded
+
+    async def is_message_log_channel(self, channel_id: int) -> bool:
+        return channel_id in (await self.load()).message_log_channels
+
+    async def is_log_channel(self, channel_id: int) -> bool:
+        return channel_id in (await self.load()).all_channels
+
+
+logging_snapshot = LoggingSnapshot()
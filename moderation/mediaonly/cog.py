@@ -1,8 +1,7 @@
-import re
-from datetime import datetime
+import asyncio
 from typing import Optional
 
-from aiohttp import ClientError, ClientSession
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
 from discord import Embed, Forbidden, Guild, Message, TextChannel
 from discord.ext import commands
 from discord.ext.commands import CommandError, Context, UserInputError, guild_only
@@ -12,34 +11,135 @@ from PyDrocsid.command import docs, reply
 from PyDrocsid.database import db, filter_by
 from PyDrocsid.embeds import send_long_embed
 from PyDrocsid.events import StopEventHandling
+from PyDrocsid.redis import redis
 from PyDrocsid.translations import t
 
 from .colors import Colors
 from .models import MediaOnlyChannel, MediaOnlyDeletion
 from .permissions import MediaOnlyPermission
 from ...contributor import Contributor
-from ...pubsub import can_respond_on_reaction, get_userlog_entries, send_alert, send_to_changelog
+from ...pubsub import can_respond_on_reaction, get_userlog_sources, send_alert, send_to_changelog
+from ...urls import get_message_urls
+from ...userlog import UserlogSource, query_source
 
 
 tg = t.g
 t = t.mediaonly
 
+# maximum time (in seconds) to probe a single url
+PROBE_TIMEOUT = 5
+
+# maximum number of urls of a single message which are probed concurrently
+MAX_CONCURRENT_PROBES = 5
+
+# minimum size (in bytes) of an image
+MIN_IMAGE_SIZE = 256
+
+# time (in seconds) for which the mime type and content length of a url are cached
+PROBE_CACHE_TTL = 24 * 60 * 60
+PROBE_ERROR_CACHE_TTL = 5 * 60
+
+_session: Optional[ClientSession] = None
+
+
+def is_image(mime: str, size: int) -> bool:
+    return mime.startswith("image/") and size >= MIN_IMAGE_SIZE
+
+
+def get_session() -> ClientSession:
+    """Return the http client session which is shared by all media probes."""
+
+    global _session
+
+    if _session is None or _session.closed:
+        _session = ClientSession(
+            timeout=ClientTimeout(total=PROBE_TIMEOUT), connector=TCPConnector(limit=100, ttl_dns_cache=300)
+        )
+
+    return _session
+
+
+def close_session():
+    """Close the session of the media probes, so its connector is not left open."""
+
+    global _session
+
+    if _session is not None and not _session.closed:
+        asyncio.create_task(_session.close())
+    _session = None
+
+
+async def probe_url(url: str) -> Optional[tuple[str, int]]:
+    """Return the mime type and the content length of a url or None if the url could not be probed."""
+
+    try:
+        async with get_session().head(url, allow_redirects=True) as response:
+            return response.headers["Content-type"], int(response.headers["Content-length"])
+    except (KeyError, ValueError, AttributeError, UnicodeError, ConnectionError, ClientError, asyncio.TimeoutError):
+        return None
+
+
+async def probe_urls(urls: list[str]) -> bool:
+    """
+    Probe multiple urls concurrently and return whether at least one of them points to an image.
+    The remaining probes are cancelled as soon as an image has been found. All results are cached in redis.
+    """
+
+    unresolved: list[str] = []
+    for url, cached in zip(urls, await redis.mget([f"mediaonly:url:{url}" for url in urls])):
+        if cached is None:
+            unresolved.append(url)
+        elif cached:
+            mime, _, size = cached.rpartition(":")
+            if is_image(mime, int(size)):
+                return True
+
+    if not unresolved:
+        return False
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_PROBES)
+
+    async def probe(url: str) -> Optional[tuple[str, int]]:
+        async with semaphore:
+            return await probe_url(url)
+
+    tasks = {asyncio.create_task(probe(url)): url for url in unresolved}
+    pending = set(tasks)
+    found = False
+    async with redis.pipeline() as pipe:
+        while pending and not found:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                result: Optional[tuple[str, int]] = task.result()
+                if result is None:
+                    await pipe.setex(f"mediaonly:url:{tasks[task]}", PROBE_ERROR_CACHE_TTL, "")
+                    continue
+
+                mime, size = result
+                await pipe.setex(f"mediaonly:url:{tasks[task]}", PROBE_CACHE_TTL, f"{mime}:{size}")
+                found = found or is_image(mime, size)
+
+        for task in pending:
+            task.cancel()
+
+        await pipe.execute()
+
+    return found
+
 
 async def contains_image(message: Message) -> bool:
-    urls = [(att.url,) for att in message.attachments]
-    urls += re.findall(r"(https?://([a-zA-Z0-9\-_~]+\.)+[a-zA-Z0-9\-_~]+(/\S*)?)", message.content)
-    for url, *_ in urls:
-        try:
-            async with ClientSession() as session, session.head(url, allow_redirects=True) as response:
-                content_length = int(response.headers["Content-length"])
-                mime = response.headers["Content-type"]
-        except (KeyError, AttributeError, UnicodeError, ConnectionError, ClientError):
-            break
-
-        if mime.startswith("image/") and content_length >= 256:
+    urls = []
+    for att in message.attachments:
+        if att.content_type is None:
+            urls.append(att.url)
+        elif is_image(att.content_type, att.size):
             return True
 
-    return False
+    urls += get_message_urls(message).http_urls
+    if not urls:
+        return False
+
+    return await probe_urls(list(dict.fromkeys(urls)))
 
 
 async def delete_message(message: Message):
@@ -78,19 +178,22 @@ async def check_message(message: Message):
 class MediaOnlyCog(Cog, name="MediaOnly"):
     CONTRIBUTORS = [Contributor.Defelo, Contributor.wolflu]
 
+    def cog_unload(self):
+        close_session()
+
     @can_respond_on_reaction.subscribe
     async def handle_can_respond_on_reaction(self, channel: TextChannel) -> bool:
         return not await db.exists(filter_by(MediaOnlyChannel, channel=channel.id))
 
-    @get_userlog_entries.subscribe
-    async def handle_get_userlog_entries(self, user_id: int, _) -> list[tuple[datetime, str]]:
-        out: list[tuple[datetime, str]] = []
-
-        deletion: MediaOnlyDeletion
-        async for deletion in await db.stream(filter_by(MediaOnlyDeletion, member=user_id)):
-            out.append((deletion.timestamp, t.ulog_deletion(f"<#{deletion.channel}>")))
-
-        return out
+    @get_userlog_sources.subscribe
+    async def handle_get_userlog_sources(self, user_id: int, _) -> list[UserlogSource]:
+        return [
+            query_source(
+                filter_by(MediaOnlyDeletion, member=user_id),
+                MediaOnlyDeletion.timestamp,
+                lambda deletion: t.ulog_deletion(f"<#{deletion.channel}>"),
+            )
+        ]
 
     async def on_message(self, message: Message):
         await check_message(message)
@@ -3,7 +3,7 @@ from datetime import datetime, timedelta
 from typing import List, Optional, Tuple, Union
 
 from discord import Embed, Forbidden, Guild, HTTPException, Member, Message, NotFound, Role, User
-from discord.ext import commands, tasks
+from discord.ext import commands
 from discord.ext.commands import CommandError, Context, Converter, guild_only
 from discord.utils import utcnow
 
@@ -16,18 +16,20 @@ from PyDrocsid.translations import t
 from PyDrocsid.util import check_role_assignable, is_teamler
 
 from .colors import Colors
-from .models import Ban, Kick, Mute, Report, Warn
+from .models import Ban, Kick, Mute, Report, Warn, get_user_stats
 from .permissions import ModPermission
+from .scheduler import BAN, MUTE, RETRY_DELAY, expiry_scheduler
 from ...contributor import Contributor
 from ...pubsub import (
     get_user_info_entries,
     get_user_status_entries,
-    get_userlog_entries,
+    get_userlog_sources,
     log_auto_kick,
     revoke_verification,
     send_alert,
     send_to_changelog,
 )
+from ...userlog import UserlogSource, query_source
 
 
 tg = t.g
@@ -35,6 +37,9 @@ t = t.mod
 
 MAX_TIMEOUT = timedelta(days=28)
 
+# interval in which the timeouts of muted members are renewed, as a timeout cannot be longer than MAX_TIMEOUT
+TIMEOUT_RENEWAL_INTERVAL = timedelta(days=1)
+
 
 class DurationConverter(Converter):
     async def convert(self, ctx, argument: str) -> Optional[int]:
@@ -93,85 +98,158 @@ async def send_to_changelog_mod(
     await send_to_changelog(guild, embed)
 
 
+def format_mute(mute: Mute) -> str:
+    text = t.ulog.muted.upgrade if mute.is_upgrade else t.ulog.muted.first
+    if mute.days == -1:
+        return text.inf(f"<@{mute.mod}>", mute.reason)
+    return text.temp(f"<@{mute.mod}>", mute.reason, cnt=mute.days)
+
+
+def format_unmute(mute: Mute) -> str:
+    if mute.unmute_mod is None:
+        return t.ulog.unmuted_expired
+    return t.ulog.unmuted(f"<@{mute.unmute_mod}>", mute.unmute_reason)
+
+
+def format_kick(kick: Kick) -> str:
+    if kick.mod is None:
+        return t.ulog.autokicked
+    return t.ulog.kicked(f"<@{kick.mod}>", kick.reason)
+
+
+def format_ban(ban: Ban) -> str:
+    text = t.ulog.banned.upgrade if ban.is_upgrade else t.ulog.banned.first
+    if ban.days == -1:
+        return text.inf(f"<@{ban.mod}>", ban.reason)
+    return text.temp(f"<@{ban.mod}>", ban.reason, cnt=ban.days)
+
+
+def format_unban(ban: Ban) -> str:
+    if ban.unban_mod is None:
+        return t.ulog.unbanned_expired
+    return t.ulog.unbanned(f"<@{ban.unban_mod}>", ban.unban_reason)
+
+
+def get_expiry(punishment: Union[Ban, Mute]) -> Optional[datetime]:
+    if punishment.days == -1:
+        return None
+    return punishment.timestamp + timedelta(days=punishment.days)
+
+
+def schedule_ban(ban: Ban):
+    if (expiry := get_expiry(ban)) is None:
+        expiry_scheduler.cancel(BAN, ban.member)
+    else:
+        expiry_scheduler.schedule(BAN, ban.member, expiry)
+
+
+def schedule_mute(mute: Mute):
+    """Schedule the expiry of a mute or the next renewal of the timeout of the muted member, whichever comes first."""
+
+    deadline = utcnow() + TIMEOUT_RENEWAL_INTERVAL
+    if (expiry := get_expiry(mute)) is not None:
+        deadline = min(deadline, expiry)
+    expiry_scheduler.schedule(MUTE, mute.member, deadline)
+
+
 class ModCog(Cog, name="Mod Tools"):
     CONTRIBUTORS = [Contributor.Defelo, Contributor.wolflu, Contributor.Florian]
 
     async def on_ready(self):
         guild: Guild = self.bot.guilds[0]
         mute_role: Optional[Role] = guild.get_role(await RoleSettings.get("mute"))
-        if mute_role is not None:
-            async for mute in await db.stream(filter_by(Mute, active=True)):
-                member: Optional[Member] = guild.get_member(mute.member)
-                if member is not None:
-                    await member.add_roles(mute_role)
 
-        try:
-            self.mod_loop.start()
-        except RuntimeError:
-            self.mod_loop.restart()
+        expiry_scheduler.clear()
+        async for mute in await db.stream(filter_by(Mute, active=True)):
+            member: Optional[Member] = guild.get_member(mute.member)
+            if mute_role is not None and member is not None:
+                await member.add_roles(mute_role)
+
+            # check expiries and timeouts of all mutes once, as they may have changed while the bot was offline
+            expiry_scheduler.schedule(MUTE, mute.member, utcnow())
+
+        async for ban in await db.stream(filter_by(Ban, active=True)):
+            schedule_ban(ban)
+
+        expiry_scheduler.start(self.handle_expiry)
+
+    def cog_unload(self):
+        expiry_scheduler.stop()
 
-    @tasks.loop(minutes=30)
     @db_wrapper
-    async def mod_loop(self):
+    async def handle_expiry(self, kind: str, user_id: int):
         guild: Guild = self.bot.guilds[0]
 
-        async for ban in await db.stream(filter_by(Ban, active=True)):
-            if ban.days != -1 and utcnow() >= ban.timestamp + timedelta(days=ban.days):
-                await Ban.deactivate(ban.id)
+        if kind == BAN:
+            for ban in await db.all(filter_by(Ban, active=True, member=user_id)):
+                await self.update_ban(guild, ban)
+        elif kind == MUTE:
+            for mute in await db.all(filter_by(Mute, active=True, member=user_id)):
+                await self.update_mute(guild, mute)
 
-                try:
-                    user = await self.bot.fetch_user(ban.member)
-                except NotFound:
-                    user = ban.member, ban.member_name
+    async def update_ban(self, guild: Guild, ban: Ban):
+        if (expiry := get_expiry(ban)) is None or utcnow() < expiry:
+            schedule_ban(ban)
+            return
 
-                if isinstance(user, User):
-                    try:
-                        await guild.unban(user)
-                    except Forbidden:
-                        await send_alert(guild, t.cannot_unban_user_permissions(user.mention, user.id))
+        await Ban.deactivate(ban.id)
+
+        try:
+            user = await self.bot.fetch_user(ban.member)
+        except NotFound:
+            user = ban.member, ban.member_name
+
+        if isinstance(user, User):
+            try:
+                await guild.unban(user)
+            except Forbidden:
+                await send_alert(guild, t.cannot_unban_user_permissions(user.mention, user.id))
 
-                await send_to_changelog_mod(guild, None, Colors.unban, t.log_unbanned, user, t.log_unbanned_expired)
+        await send_to_changelog_mod(guild, None, Colors.unban, t.log_unbanned, user, t.log_unbanned_expired)
 
+    async def update_mute(self, guild: Guild, mute: Mute):
         mute_role: Optional[Role] = guild.get_role(await RoleSettings.get("mute"))
         if mute_role is None:
+            expiry_scheduler.schedule(MUTE, mute.member, utcnow() + RETRY_DELAY)
             return
 
         try:
             check_role_assignable(mute_role)
         except CommandError:
             await send_alert(guild, t.cannot_assign_mute_role(mute_role, mute_role.id))
+            expiry_scheduler.schedule(MUTE, mute.member, utcnow() + RETRY_DELAY)
             return
 
-        mute: Mute
-        async for mute in await db.stream(filter_by(Mute, active=True)):
-            member = guild.get_member(mute.member)
-            timeout: datetime | None = member.communication_disabled_until if member else None
-
-            if mute.days != -1 and utcnow() >= mute.timestamp + timedelta(days=mute.days):
-                if member:
-                    await member.remove_roles(mute_role)
-                    try:
-                        await member.remove_timeout()
-                    except Forbidden:
-                        await send_alert(guild, t.cannot_remove_timeout(member.mention, member.id))
-                else:
-                    member = mute.member, mute.member_name
-
-                await send_to_changelog_mod(guild, None, Colors.unmute, t.log_unmuted, member, t.log_unmuted_expired)
-                await Mute.deactivate(mute.id)
-            elif member and mute.days == -1:
-                try:
-                    await member.timeout_for(MAX_TIMEOUT)
-                except Forbidden:
-                    await send_alert(guild, t.cannot_update_timeout(member.mention, member.id))
-            elif member and (
-                not timeout or timeout + timedelta(seconds=2) < mute.timestamp + timedelta(days=mute.days)
-            ):
-                delta = min(mute.timestamp + timedelta(days=mute.days) - utcnow(), MAX_TIMEOUT)
+        member = guild.get_member(mute.member)
+        timeout: datetime | None = member.communication_disabled_until if member else None
+        expiry = get_expiry(mute)
+
+        if expiry is not None and utcnow() >= expiry:
+            if member:
+                await member.remove_roles(mute_role)
                 try:
-                    await member.timeout_for(delta)
+                    await member.remove_timeout()
                 except Forbidden:
-                    await send_alert(guild, t.cannot_update_timeout(member.mention, member.id))
+                    await send_alert(guild, t.cannot_remove_timeout(member.mention, member.id))
+            else:
+                member = mute.member, mute.member_name
+
+            await send_to_changelog_mod(guild, None, Colors.unmute, t.log_unmuted, member, t.log_unmuted_expired)
+            await Mute.deactivate(mute.id)
+            return
+
+        if member and expiry is None:
+            try:
+                await member.timeout_for(MAX_TIMEOUT)
+            except Forbidden:
+                await send_alert(guild, t.cannot_update_timeout(member.mention, member.id))
+        elif member and (not timeout or timeout + timedelta(seconds=2) < expiry):
+            try:
+                await member.timeout_for(min(expiry - utcnow(), MAX_TIMEOUT))
+            except Forbidden:
+                await send_alert(guild, t.cannot_update_timeout(member.mention, member.id))
+
+        schedule_mute(mute)
 
     @log_auto_kick.subscribe
     async def handle_log_auto_kick(self, member: Member):
@@ -180,26 +258,20 @@ class ModCog(Cog, name="Mod Tools"):
     @get_user_info_entries.subscribe
     async def handle_get_user_stats_entries(self, user_id: int) -> list[tuple[str, str]]:
         out: list[tuple[str, str]] = []
+        stats = await get_user_stats(user_id)
 
-        async def count(cls):
-            if cls is Report:
-                active = await db.count(filter_by(cls, reporter=user_id))
-            else:
-                active = await db.count(filter_by(cls, mod=user_id))
-
-            passive = await db.count(filter_by(cls, member=user_id))
-
-            if cls is Kick:
-                if auto_kicks := await db.count(filter_by(cls, member=user_id, mod=None)):
-                    return t.active_passive(active, passive - auto_kicks) + "\n" + t.autokicks(cnt=auto_kicks)
+        def count(name: str) -> str:
+            active, passive = stats[f"{name}_active"], stats[f"{name}_passive"]
+            if name == "kick" and (auto_kicks := stats["kick_auto"]):
+                return t.active_passive(active, passive - auto_kicks) + "\n" + t.autokicks(cnt=auto_kicks)
 
             return t.active_passive(active, passive)
 
-        out.append((t.reported_cnt, await count(Report)))
-        out.append((t.warned_cnt, await count(Warn)))
-        out.append((t.muted_cnt, await count(Mute)))
-        out.append((t.kicked_cnt, await count(Kick)))
-        out.append((t.banned_cnt, await count(Ban)))
+        out.append((t.reported_cnt, count("report")))
+        out.append((t.warned_cnt, count("warn")))
+        out.append((t.muted_cnt, count("mute")))
+        out.append((t.kicked_cnt, count("kick")))
+        out.append((t.banned_cnt, count("ban")))
 
         return out
 
@@ -222,59 +294,43 @@ class ModCog(Cog, name="Mod Tools"):
                 status = t.status_muted
         return [(t.active_sanctions, status)]
 
-    @get_userlog_entries.subscribe
-    async def handle_get_userlog_entries(self, user_id: int, author: Member) -> list[tuple[datetime, str]]:
-        out: list[tuple[datetime, str]] = []
+    @get_userlog_sources.subscribe
+    async def handle_get_userlog_sources(self, user_id: int, author: Member) -> list[UserlogSource]:
+        sources: list[UserlogSource] = []
 
         if await is_teamler(author):
-            report: Report
-            async for report in await db.stream(filter_by(Report, member=user_id)):
-                out.append((report.timestamp, t.ulog.reported(f"<@{report.reporter}>", report.reason)))
-
-        warn: Warn
-        async for warn in await db.stream(filter_by(Warn, member=user_id)):
-            out.append((warn.timestamp, t.ulog.warned(f"<@{warn.mod}>", warn.reason)))
-
-        mute: Mute
-        async for mute in await db.stream(filter_by(Mute, member=user_id)):
-            text = t.ulog.muted.upgrade if mute.is_upgrade else t.ulog.muted.first
-
-            if mute.days == -1:
-                out.append((mute.timestamp, text.inf(f"<@{mute.mod}>", mute.reason)))
-            else:
-                out.append((mute.timestamp, text.temp(f"<@{mute.mod}>", mute.reason, cnt=mute.days)))
-
-            if not mute.active and not mute.upgraded:
-                if mute.unmute_mod is None:
-                    out.append((mute.deactivation_timestamp, t.ulog.unmuted_expired))
-                else:
-                    out.append(
-                        (mute.deactivation_timestamp, t.ulog.unmuted(f"<@{mute.unmute_mod}>", mute.unmute_reason))
-                    )
-
-        kick: Kick
-        async for kick in await db.stream(filter_by(Kick, member=user_id)):
-            if kick.mod is not None:
-                out.append((kick.timestamp, t.ulog.kicked(f"<@{kick.mod}>", kick.reason)))
-            else:
-                out.append((kick.timestamp, t.ulog.autokicked))
+            sources.append(
+                query_source(
+                    filter_by(Report, member=user_id),
+                    Report.timestamp,
+                    lambda report: t.ulog.reported(f"<@{report.reporter}>", report.reason),
+                )
+            )
 
-        ban: Ban
-        async for ban in await db.stream(filter_by(Ban, member=user_id)):
-            text = t.ulog.banned.upgrade if ban.is_upgrade else t.ulog.banned.first
+        sources.append(
+            query_source(
+                filter_by(Warn, member=user_id),
+                Warn.timestamp,
+                lambda warn: t.ulog.warned(f"<@{warn.mod}>", warn.reason),
+            )
+        )
 
-            if ban.days == -1:
-                out.append((ban.timestamp, text.inf(f"<@{ban.mod}>", ban.reason)))
-            else:
-                out.append((ban.timestamp, text.temp(f"<@{ban.mod}>", ban.reason, cnt=ban.days)))
+        for model, format_entry, format_deactivation in [
+            (Mute, format_mute, format_unmute),
+            (Ban, format_ban, format_unban),
+        ]:
+            sources.append(query_source(filter_by(model, member=user_id), model.timestamp, format_entry))
+            sources.append(
+                query_source(
+                    filter_by(model, member=user_id).filter(model.active.is_(False), model.upgraded.is_not(True)),
+                    model.deactivation_timestamp,
+                    format_deactivation,
+                )
+            )
 
-            if not ban.active and not ban.upgraded:
-                if ban.unban_mod is None:
-                    out.append((ban.deactivation_timestamp, t.ulog.unbanned_expired))
-                else:
-                    out.append((ban.deactivation_timestamp, t.ulog.unbanned(f"<@{ban.unban_mod}>", ban.unban_reason)))
+        sources.append(query_source(filter_by(Kick, member=user_id), Kick.timestamp, format_kick))
 
-        return out
+        return sources
 
     async def on_member_join(self, member: Member):
         mute: Mute | None = await db.get(Mute, active=True, member=member.id)
@@ -398,17 +454,18 @@ class ModCog(Cog, name="Mod Tools"):
         server_embed.set_author(name=str(user), icon_url=user.display_avatar.url)
 
         if days is not None:
-            await Mute.create(user.id, str(user), ctx.author.id, days, reason, bool(active_mutes))
+            mute = await Mute.create(user.id, str(user), ctx.author.id, days, reason, bool(active_mutes))
             user_embed.description = t.muted(ctx.author.mention, ctx.guild.name, reason, cnt=days)
             await send_to_changelog_mod(
                 ctx.guild, ctx.message, Colors.mute, t.log_muted, user, reason, duration=t.log_field.days(cnt=days)
             )
         else:
-            await Mute.create(user.id, str(user), ctx.author.id, -1, reason, bool(active_mutes))
+            mute = await Mute.create(user.id, str(user), ctx.author.id, -1, reason, bool(active_mutes))
             user_embed.description = t.muted_inf(ctx.author.mention, ctx.guild.name, reason)
             await send_to_changelog_mod(
                 ctx.guild, ctx.message, Colors.mute, t.log_muted, user, reason, duration=t.log_field.days_infinity
             )
+        schedule_mute(mute)
 
         try:
             await user.send(embed=user_embed)
@@ -449,6 +506,8 @@ class ModCog(Cog, name="Mod Tools"):
         if not was_muted:
             raise UserCommandError(user, t.not_muted)
 
+        expiry_scheduler.cancel(MUTE, user.id)
+
         server_embed = Embed(title=t.unmute, description=t.unmuted_response, colour=Colors.ModTools)
         server_embed.set_author(name=str(user), icon_url=user.display_avatar.url)
         await reply(ctx, embed=server_embed)
@@ -534,23 +593,25 @@ class ModCog(Cog, name="Mod Tools"):
             await Ban.upgrade(ban.id, ctx.author.id)
         async for mute in await db.stream(filter_by(Mute, active=True, member=user.id)):
             await Mute.upgrade(mute.id, ctx.author.id)
+        expiry_scheduler.cancel(MUTE, user.id)
 
         user_embed = Embed(title=t.ban, colour=Colors.ModTools)
         server_embed = Embed(title=t.ban, description=t.banned_response, colour=Colors.ModTools)
         server_embed.set_author(name=str(user), icon_url=user.display_avatar.url)
 
         if ban_days is not None:
-            await Ban.create(user.id, str(user), ctx.author.id, ban_days, reason, bool(active_bans))
+            ban = await Ban.create(user.id, str(user), ctx.author.id, ban_days, reason, bool(active_bans))
             user_embed.description = t.banned(ctx.author.mention, ctx.guild.name, reason, cnt=ban_days)
             await send_to_changelog_mod(
                 ctx.guild, ctx.message, Colors.ban, t.log_banned, user, reason, duration=t.log_field.days(cnt=ban_days)
             )
         else:
-            await Ban.create(user.id, str(user), ctx.author.id, -1, reason, bool(active_bans))
+            ban = await Ban.create(user.id, str(user), ctx.author.id, -1, reason, bool(active_bans))
             user_embed.description = t.banned_inf(ctx.author.mention, ctx.guild.name, reason)
             await send_to_changelog_mod(
                 ctx.guild, ctx.message, Colors.ban, t.log_banned, user, reason, duration=t.log_field.days_infinity
             )
+        schedule_ban(ban)
 
         try:
             await user.send(embed=user_embed)
@@ -591,6 +652,8 @@ class ModCog(Cog, name="Mod Tools"):
         if not was_banned:
             raise UserCommandError(user, t.not_banned)
 
+        expiry_scheduler.cancel(BAN, user.id)
+
         server_embed = Embed(title=t.unban, description=t.unbanned_response, colour=Colors.ModTools)
         server_embed.set_author(name=str(user), icon_url=user.display_avatar.url)
         await reply(ctx, embed=server_embed)
@@ -1,12 +1,22 @@
 from __future__ import annotations
 
+import asyncio
 from datetime import datetime
 from typing import Optional, Union
 
 from discord.utils import utcnow
-from sqlalchemy import BigInteger, Boolean, Column, Integer, Text
+from sqlalchemy import BigInteger, Boolean, Column, Integer, Text, event, func, literal_column, union_all
 
-from PyDrocsid.database import Base, UTCDateTime, db
+from PyDrocsid.database import Base, UTCDateTime, db, select
+from PyDrocsid.environment import CACHE_TTL
+from PyDrocsid.logger import get_logger
+from PyDrocsid.redis import redis
+
+
+logger = get_logger(__name__)
+
+# pending invalidations of cached user stats, a reference is kept so they are not garbage collected before they finish
+_invalidations: set[asyncio.Task[int]] = set()
 
 
 class Report(Base):
@@ -23,6 +33,7 @@ class Report(Base):
     async def create(member: int, member_name: str, reporter: int, reason: str) -> Report:
         row = Report(member=member, member_name=member_name, reporter=reporter, timestamp=utcnow(), reason=reason)
         await db.add(row)
+        invalidate_user_stats(member, reporter)
         return row
 
 
@@ -40,6 +51,7 @@ class Warn(Base):
     async def create(member: int, member_name: str, mod: int, reason: str) -> Warn:
         row = Warn(member=member, member_name=member_name, mod=mod, timestamp=utcnow(), reason=reason)
         await db.add(row)
+        invalidate_user_stats(member, mod)
         return row
 
 
@@ -76,6 +88,7 @@ class Mute(Base):
             is_upgrade=is_upgrade,
         )
         await db.add(row)
+        invalidate_user_stats(member, mod)
         return row
 
     @staticmethod
@@ -107,6 +120,7 @@ class Kick(Base):
     async def create(member: int, member_name: str, mod: Optional[int], reason: Optional[str]) -> Kick:
         row = Kick(member=member, member_name=member_name, mod=mod, timestamp=utcnow(), reason=reason)
         await db.add(row)
+        invalidate_user_stats(member, mod)
         return row
 
 
@@ -143,6 +157,7 @@ class Ban(Base):
             is_upgrade=is_upgrade,
         )
         await db.add(row)
+        invalidate_user_stats(member, mod)
         return row
 
     @staticmethod
@@ -158,3 +173,65 @@ class Ban(Base):
     async def upgrade(ban_id: int, mod: int):
         ban = await Ban.deactivate(ban_id, mod)
         ban.upgraded = True
+
+
+async def get_user_stats(user_id: int) -> dict[str, int]:
+    """
+    Return the number of reports, warns, mutes, kicks and bans issued by (active) and against (passive) a user.
+
+    All counts are queried using a single aggregated query and cached until a new row is created for this user.
+    """
+
+    if stats := await redis.hgetall(key := f"mod:user_stats:{user_id}"):
+        return {name: int(count) for name, count in stats.items()}
+
+    queries = []
+    for name, model, actor in [
+        ("report", Report, Report.reporter),
+        ("warn", Warn, Warn.mod),
+        ("mute", Mute, Mute.mod),
+        ("kick", Kick, Kick.mod),
+        ("ban", Ban, Ban.mod),
+    ]:
+        for role, condition in [("active", actor == user_id), ("passive", model.member == user_id)]:
+            queries.append(
+                select(literal_column(f"'{name}_{role}'").label("name"), func.count().label("cnt"))
+                .select_from(model)
+                .filter(condition)
+            )
+    queries.append(
+        select(literal_column("'kick_auto'").label("name"), func.count().label("cnt"))
+        .select_from(Kick)
+        .filter(Kick.member == user_id, Kick.mod.is_(None))
+    )
+
+    stats: dict[str, int] = dict((await db.exec(union_all(*queries))).all())
+    async with redis.pipeline() as pipe:
+        await pipe.hset(key, mapping=stats)
+        await pipe.expire(key, CACHE_TTL)
+        await pipe.execute()
+
+    return stats
+
+
+def invalidate_user_stats(*user_ids: Optional[int]):
+    """
+    Remove the cached stats of the given users as soon as the current transaction has been committed.
+
+    Removing them before the commit would allow a concurrent get_user_stats to cache the old counts again.
+    """
+
+    keys = [f"mod:user_stats:{user_id}" for user_id in user_ids if user_id is not None]
+
+    def after_commit(_):
+        task = asyncio.create_task(redis.delete(*keys))
+        _invalidations.add(task)
+        task.add_done_callback(invalidation_done)
+
+    event.listen(db.session.sync_session, "after_commit", after_commit, once=True)
+
+
+def invalidation_done(task: asyncio.Task[int]):
+    _invalidations.discard(task)
+    if not task.cancelled() and (exception := task.exception()) is not None:
+        logger.error("could not invalidate cached user stats", exc_info=exception)
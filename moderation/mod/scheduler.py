@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional
+
+from discord.utils import utcnow
+
+from PyDrocsid.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+# kinds of scheduled expiries, the key of an expiry is the kind together with the id of the punished user
+BAN = "ban"
+MUTE = "mute"
+
+# delay after which an expiry is retried if it could not be handled
+RETRY_DELAY = timedelta(minutes=30)
+
+
+class ExpiryScheduler:
+    """
+    Scheduler for the expiry of temporary bans and mutes.
+
+    The deadlines are kept in a min-heap and a single task sleeps until the earliest one, so punishments expire on
+    time and nothing runs while no deadline is due. Rescheduling or cancelling a key only updates the current
+    deadline of this key, outdated heap entries are skipped when they reach the top of the heap.
+    """
+
+    def __init__(self):
+        self.heap: list[tuple[datetime, str, int]] = []
+        self.deadlines: dict[tuple[str, int], datetime] = {}
+        self.changed = asyncio.Event()
+        self.callback: Optional[Callable[[str, int], Awaitable[None]]] = None
+        self.task: Optional[asyncio.Task[None]] = None
+
+    def start(self, callback: Callable[[str, int], Awaitable[None]]):
+        self.stop()
+        self.callback = callback
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def clear(self):
+        self.heap.clear()
+        self.deadlines.clear()
+        self.changed.set()
+
+    def schedule(self, kind: str, user_id: int, deadline: datetime):
+        self.deadlines[(kind, user_id)] = deadline
+        heapq.heappush(self.heap, (deadline, kind, user_id))
+        if self.heap[0][0] == deadline:
+            self.changed.set()
+
+    def cancel(self, kind: str, user_id: int):
+        self.deadlines.pop((kind, user_id), None)
+
+    def get_deadline(self, kind: str, user_id: int) -> Optional[datetime]:
+        return self.deadlines.get((kind, user_id))
+
+    def _next_deadline(self) -> Optional[datetime]:
+        while self.heap:
+            deadline, kind, user_id = self.heap[0]
+            if self.deadlines.get((kind, user_id)) == deadline:
+                return deadline
+            heapq.heappop(self.heap)
+        return None
+
+    async def run(self):
+        while True:
+            self.changed.clear()
+            if (deadline := self._next_deadline()) is None:
+                await self.changed.wait()
+                continue
+
+            if (delay := (deadline - utcnow()).total_seconds()) > 0:
+                try:
+                    await asyncio.wait_for(self.changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, kind, user_id = heapq.heappop(self.heap)
+            del self.deadlines[(kind, user_id)]
+            try:
+                await self.callback(kind, user_id)
+            except Exception:
+                logger.exception("could not handle expiry of %s of %d", kind, user_id)
+                if self.get_deadline(kind, user_id) is None:
+                    self.schedule(kind, user_id, utcnow() + RETRY_DELAY)
+
+
+expiry_scheduler = ExpiryScheduler()
@@ -1,4 +1,3 @@
-from datetime import datetime
 from typing import Optional, Union
 
 from discord import Embed, Member, User
@@ -19,7 +18,8 @@ from .colors import Colors
 from .models import UserNote
 from .permissions import UserNotePermission
 from ...contributor import Contributor
-from ...pubsub import get_userlog_entries, send_to_changelog
+from ...pubsub import get_userlog_sources, send_to_changelog
+from ...userlog import UserlogSource, query_source
 
 
 tg = t.g
@@ -29,20 +29,18 @@ t = t.user_notes
 class UserNoteCog(Cog, name="User Notes"):
     CONTRIBUTORS = [Contributor.Florian, Contributor.Defelo]
 
-    @get_userlog_entries.subscribe
-    async def handle_get_userlog_entries(self, user_id: int, author: Member) -> list[tuple[datetime, str]]:
+    @get_userlog_sources.subscribe
+    async def handle_get_userlog_sources(self, user_id: int, author: Member) -> list[UserlogSource]:
         if not await is_teamler(author):
             return []
 
-        out: list[tuple[datetime, str]] = []
-
-        note: UserNote
-        async for note in await db.stream(select(UserNote).filter_by(member_id=user_id)):
-            out.append(
-                (note.timestamp, t.ulog_entry(f"<@{note.author_id}>", "\n" * ("\n" in note.content) + note.content))
+        return [
+            query_source(
+                select(UserNote).filter_by(member_id=user_id),
+                UserNote.timestamp,
+                lambda note: t.ulog_entry(f"<@{note.author_id}>", "\n" * ("\n" in note.content) + note.content),
             )
-
-        return out
+        ]
 
     @commands.group(aliases=["un"])
     @UserNotePermission.read.check
@@ -7,6 +7,7 @@ log_auto_kick = PubSubChannel()
 get_user_info_entries = PubSubChannel()
 get_user_status_entries = PubSubChannel()
 get_userlog_entries = PubSubChannel()
+get_userlog_sources = PubSubChannel()
 revoke_verification = PubSubChannel()
 can_respond_on_reaction = PubSubChannel()
 ignore_message_edit = PubSubChannel()
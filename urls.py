@@ -0,0 +1,59 @@
+import re
+from collections import OrderedDict
+from typing import NamedTuple
+
+from discord import Message
+
+
+URL_PATTERN = re.compile(r"(?P<host>(?P<scheme>https?://)?([a-zA-Z0-9\-_~]+\.)+[a-zA-Z0-9\-_~.]+)(?P<path>\S*)")
+INVITE_PATTERN = re.compile(r"(discord\.gg/|discord(app)?\.com/invite/)[a-zA-Z0-9]+", re.IGNORECASE)
+TRAILING_PATTERN = re.compile(r"[^a-zA-Z0-9]+$")
+
+# number of messages for which the extracted urls are kept in memory
+CACHE_SIZE = 1024
+
+_cache: OrderedDict[int, tuple[str, "MessageUrls"]] = OrderedDict()
+
+
+class MessageUrls(NamedTuple):
+    # all url candidates with and without trailing punctuation, including those without a scheme
+    candidates: frozenset[str]
+    # urls with an explicit http(s) scheme in order of appearance
+    http_urls: tuple[str, ...]
+
+
+def extract_urls(text: str) -> MessageUrls:
+    """Extract all urls from a text in a single pass."""
+
+    candidates: set[str] = set()
+    http_urls: list[str] = []
+    for match in URL_PATTERN.finditer(text):
+        host, path = match.group("host"), match.group("path")
+        candidates.add(host + path)
+        candidates.add(host + TRAILING_PATTERN.sub("", path))
+
+        if match.group("scheme"):
+            host = host.rstrip(".")
+            http_urls.append(host + path if path.startswith("/") else host)
+
+    # invite links may be embedded in other words, which would hide them in the url candidates above
+    if "discord" in text.lower():
+        candidates.update(match[0] for match in INVITE_PATTERN.finditer(text))
+
+    return MessageUrls(frozenset(candidates), tuple(http_urls))
+
+
+def get_message_urls(message: Message) -> MessageUrls:
+    """Return the urls of a message. Results are memoized per message id, so each message is only scanned once."""
+
+    if (cached := _cache.get(message.id)) is not None and cached[0] == message.content:
+        _cache.move_to_end(message.id)
+        return cached[1]
+
+    urls = extract_urls(message.content)
+    _cache[message.id] = message.content, urls
+    _cache.move_to_end(message.id)
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+
+    return urls
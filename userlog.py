@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import heapq
+from datetime import datetime
+from itertools import islice
+from typing import Any, Awaitable, Callable, NamedTuple, Optional
+
+from sqlalchemy import Column
+from sqlalchemy.sql import Select
+
+from PyDrocsid.database import db, db_context
+
+
+# an entry of a userlog: the timestamp of the event and its description
+UserlogEntry = tuple[datetime, str]
+
+# a source of userlog entries, which is called with a timestamp and a limit and returns at most limit entries
+# whose timestamp is greater than or equal to the given timestamp (or all entries if it is None), ordered by timestamp
+UserlogSource = Callable[[Optional[datetime], int], Awaitable[list[UserlogEntry]]]
+
+
+class Cursor(NamedTuple):
+    """Position in a userlog timeline."""
+
+    # timestamp of the last entry before this position
+    timestamp: Optional[datetime]
+    # number of entries with this timestamp before this position
+    skip: int
+
+    def advance(self, entries: list[UserlogEntry]) -> Cursor:
+        """Return the position after the given entries, which must directly follow this position."""
+
+        if not entries:
+            return self
+
+        timestamp = entries[-1][0]
+        count = sum(entry[0] == timestamp for entry in entries)
+        if timestamp == self.timestamp:
+            return Cursor(timestamp, self.skip + count)
+        return Cursor(timestamp, count)
+
+
+# position of the first entry of a timeline
+START = Cursor(None, 0)
+
+
+def query_source(statement: Select, timestamp: Column, format_row: Callable[[Any], str]) -> UserlogSource:
+    """
+    Create a userlog source from a select statement.
+
+    The rows are fetched in pages using a keyset on the timestamp column (and the id as a tie-breaker),
+    so only the rows around the requested position are loaded.
+    """
+
+    async def fetch(after: Optional[datetime], limit: int) -> list[UserlogEntry]:
+        query = statement if after is None else statement.filter(timestamp >= after)
+        rows = await db.all(query.order_by(timestamp, timestamp.class_.id).limit(limit))
+        return [(getattr(row, timestamp.key), format_row(row)) for row in rows]
+
+    return fetch
+
+
+def static_source(*entries: UserlogEntry) -> UserlogSource:
+    """Create a userlog source from a fixed list of entries."""
+
+    entries = sorted(entries, key=lambda entry: entry[0])
+
+    async def fetch(after: Optional[datetime], limit: int) -> list[UserlogEntry]:
+        return [entry for entry in entries if after is None or entry[0] >= after][:limit]
+
+    return fetch
+
+
+class UserlogTimeline:
+    """
+    Lazy timeline of the userlog entries of multiple sources.
+
+    Each page is loaded on demand by fetching the entries after the cursor of the page from every source and merging
+    them with a k-way heap merge. Entries with equal timestamps keep the order of their sources, so a cursor
+    (timestamp of the last entry and number of entries with this timestamp) always identifies the same position.
+    """
+
+    def __init__(self, sources: list[UserlogSource]):
+        self.sources: list[UserlogSource] = sources
+
+    async def fetch(self, cursor: Cursor, limit: int) -> list[UserlogEntry]:
+        """Return at most limit entries after the given cursor."""
+
+        async with db_context():
+            results = [await source(cursor.timestamp, cursor.skip + limit) for source in self.sources]
+
+        merged = heapq.merge(*results, key=lambda entry: entry[0])
+        return list(islice(merged, cursor.skip, cursor.skip + limit))